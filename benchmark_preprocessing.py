@@ -0,0 +1,158 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+import argparse
+import logging
+import time
+import sys
+import os
+
+import numpy as np
+
+# Import from local folders
+sys.path.append('./utils')
+from utils.preprocessing import PREPROCESSING_BACKENDS
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+class InputTensor:
+    """Preallocated NCHW model input. Frames larger than the model input are resized on the
+    CPU first (OpenCV, or nearest neighbour with NumPy when OpenCV is not installed), frames
+    resized by the camera GPU only get the layout conversion"""
+
+    def __init__(self, model_image_dimensions):
+        self._width, self._height = model_image_dimensions
+        self.tensor = np.empty((1, 3, self._height, self._width), dtype=np.float32)
+        self._resized = np.empty((self._height, self._width, 3), dtype=np.uint8)
+        try:
+            import cv2
+            self._cv2 = cv2
+        except ImportError:
+            self._cv2 = None
+
+    def _resize(self, frame):
+        if (frame.shape[:2] == (self._height, self._width)):
+            return frame
+        if (self._cv2 is not None):
+            return self._cv2.resize(frame, (self._width, self._height), dst=self._resized,
+                                    interpolation=self._cv2.INTER_LINEAR)
+        rows = ((np.arange(self._height) + 0.5) * frame.shape[0] / self._height).astype(np.intp)
+        cols = ((np.arange(self._width) + 0.5) * frame.shape[1] / self._width).astype(np.intp)
+        np.take(np.take(frame, rows, axis=0), cols, axis=1, out=self._resized)
+        return self._resized
+
+    def set_frame(self, frame):
+        np.copyto(self.tensor[0], self._resize(frame).transpose(2, 0, 1), casting='unsafe')
+        return self.tensor
+
+
+def frame_dimensions(backend, args):
+    """Dimensions of the frames the detection loop gets with the backend"""
+    if (backend == "camera"):
+        return tuple(args.model_dimensions)
+    return tuple(args.camera_dimensions)
+
+
+def time_per_frame(function, frames, iterations):
+    function(frames[0])  # warm up
+    start = time.perf_counter()
+    for i in range(iterations):
+        function(frames[i % len(frames)])
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def capture_times(backend, args):
+    """Wall and CPU time per captured frame, with the camera settings of the detection
+    process. The wall time is at least the frame period, the CPU time shows what the
+    process spends on every frame"""
+    try:
+        from picamera import PiCamera
+        from picamera.array import PiRGBArray
+    except ImportError:
+        log.info("Benchmark: picamera is not installed, skipping capture")
+        return None
+    dimensions = frame_dimensions(backend, args)
+    resize = dimensions if (backend == "camera") else None
+    camera = PiCamera()
+    try:
+        camera.resolution = tuple(args.camera_dimensions)
+        camera.framerate = args.framerate
+        raw_capture = PiRGBArray(camera, size=dimensions)
+        frames = []
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        for frame in camera.capture_continuous(raw_capture, format="bgr", use_video_port=True, resize=resize):
+            frames.append(frame.array.copy())
+            raw_capture.truncate(0)
+            if (len(frames) >= args.captures):
+                break
+        return ((time.perf_counter() - start) / len(frames) * 1000,
+                (time.process_time() - cpu_start) / len(frames) * 1000, frames)
+    finally:
+        camera.close()
+
+
+def detector_time(args, frames):
+    """Time per detection of the frames, including the resizing done by the detector"""
+    if (not all(os.path.exists(name) for name in args.model)):
+        log.info("Benchmark: model %s not found, skipping detection", args.model[0])
+        return None
+    try:
+        from lib.rtpd.detector import Detector
+    except ImportError:
+        log.info("Benchmark: detector is not installed, skipping detection")
+        return None
+    detector = Detector(tuple(args.model), tuple(args.model_dimensions), args.device)
+    detector.set_detection_areas([[]])
+    return time_per_frame(detector.detect_from_image, frames, args.iterations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the preprocessing backends of the detection "
+                                                 "process (PREPROCESSING=camera|detector)")
+    parser.add_argument('--backends', nargs='+', choices=PREPROCESSING_BACKENDS, default=list(PREPROCESSING_BACKENDS))
+    parser.add_argument('--camera-dimensions', nargs=2, type=int, default=[1920, 1080])
+    parser.add_argument('--model-dimensions', nargs=2, type=int, default=[544, 320])
+    parser.add_argument('--framerate', type=int, default=30,
+                        help="camera framerate, high so that capture is not limited by the frame period")
+    parser.add_argument('--captures', type=int, default=30, help="frames to capture per backend")
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--device', default="MYRIAD", help="inference device")
+    parser.add_argument('--model', nargs=2, default=["models/pd_retail_13/FP16/model.xml",
+                                                     "models/pd_retail_13/FP16/model.bin"])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for backend in args.backends:
+        width, height = frame_dimensions(backend, args)
+        results = {}
+        captured = capture_times(backend, args)
+        if (captured is not None):
+            results["capture"], results["capture CPU"], frames = captured
+        else:
+            frames = [rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(4)]
+        input_tensor = InputTensor(tuple(args.model_dimensions))
+        results["resize + NCHW"] = time_per_frame(input_tensor.set_frame, frames, args.iterations)
+        detection = detector_time(args, frames)
+        if (detection is not None):
+            results["detection"] = detection
+        for name, ms in results.items():
+            print("%-10s %4dx%-4d %-14s %8.2f ms/frame" % (backend, width, height, name, ms))
+
+
+if __name__ == '__main__':
+    main()
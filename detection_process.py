@@ -13,15 +13,19 @@
 #      limitations under the License.
 #
 
-from lib.rtpd.detector import Detector
-from picamera.exc import PiCameraMMALError
-from picamera import PiCamera
-from picamera.array import PiRGBArray
 import multiprocessing
-from multiprocessing import Event, Process, Queue, Manager
+from multiprocessing import Event, Process, Queue, Value
+from collections import deque
+import threading
+import queue
 import sys
 import time
 import logging
+from utils.detection_cache import DetectionRing
+from utils.logs import init_process_logging, logging_settings
+from utils.preprocessing import PREPROCESSING_BACKENDS
+from utils.profiling import LoopProfiler
+from utils.records import DetectionRecord, FrameTiming
 log = logging.getLogger(__name__)
 
 # Import from local folders
@@ -29,39 +33,100 @@ sys.path.append('./libs')
 
 
 class RTPDProcess:
-	def __init__(self, detection_queue, detection_areas, detection_threshold=0.6, model_image_dimensions=(544, 320), model_loc=("models/pd_retail_13/FP16/model.xml", "models/pd_retail_13/FP16/model.bin")):
+	"""Detection process. PiCamera, the detector runtime and the NumPy based detection
+	modules are imported by the detection process only, so the client process does not
+	load them."""
+
+	def __init__(self, max_detections, detection_areas, counting_line, heartbeats, detection_threshold=60, model_image_dimensions=(544, 320), model_loc=("models/pd_retail_13/FP16/model.xml", "models/pd_retail_13/FP16/model.bin"), camera_dimensions=(1920, 1080), max_cached_detections=30, max_frame_timings=100, preprocessing="detector"):
 		self._detection_process = None
 
 		# Camera configuration settings
-		self._camera_dimensions = (1920,1080)
+		self._camera_dimensions = tuple(camera_dimensions)
 		self._camera_framerate = 1  # fps
 
-		# Detector initialization variables
+		# Detector initialization variables. With camera preprocessing, the camera GPU
+		# resizes frames to the model input while capturing
 		self._model_image_dimensions = model_image_dimensions
+		if (preprocessing not in PREPROCESSING_BACKENDS):
+			raise ValueError("preprocessing must be one of %s" % ", ".join(PREPROCESSING_BACKENDS))
+		self._preprocessing = preprocessing
 		self._model_loc = model_loc
-		self._detection_threshold = detection_threshold
 
-		# Detection configuration variables
-		self._detection_queue: Queue[str] = detection_queue
+		# Detection configuration variables, zones and counting line are SharedJSON values
+		self._max_detections = max_detections
 		self._detection_areas = detection_areas
+		self._counting_line = counting_line
+
+		# Watchdog heartbeats of the capture and inference stages
+		self._heartbeats = heartbeats
+
+		self._max_frame_timings = max_frame_timings
+
+		# Logging settings of the client, applied in a spawned detection process
+		self._logging_settings = logging_settings()
+
+		# Raw detections of the last frames are kept to recount people immediately when
+		# zones or threshold change. The detector keeps detections down to a fraction of
+		# the threshold, so lowering the threshold can be recounted too
+		self._max_cached_detections = max_cached_detections
+		self._cache_threshold_ratio = 0.5
 
 		# Detection process status
 		self._detection_enabled = False
 		self._detecting = False
+		self._started_at = None
 
+		self._create_shared_state(detection_threshold, 0.0, 0, 0, 0)
+
+	def _create_shared_state(self, detection_threshold, detection_interval, dropped_detections, entries, exits):
+		"""Creates the queues, values and events shared with the detection process. They are
+		created again after the process was killed, since it may have held one of their locks"""
+		self._detection_queue = Queue(self._max_detections)
+		# Shared, so that a threshold change can be applied to cached detections right away.
+		# In percent, like confidences from detection_arrays
+		self._detection_threshold = Value('d', detection_threshold)
+		# Backpressure from the network thread: minimum time between detections (seconds)
+		# and number of results dropped because the queue was full
+		self._detection_interval = Value('d', detection_interval)
+		self._dropped_detections = Value('i', dropped_detections)
+		# Entries and exits counted since the client started, kept across process restarts
+		self._entries_total = Value('i', entries)
+		self._exits_total = Value('i', exits)
+		# Commands from the client to a running detection process and their results
+		self._command_queue = Queue(10)
+		self._command_results = Queue(10)
+		self._configuration_changed = Event()
 		# Client operation status events shared between threads and processes
 		self._detection_stop_event = Event()
 		self._detection_started_event = Event()
 		self._detection_failed_event = Event()
 
-	def _detection_process_target(self, detection_areas, max_try=5):
+	def _detection_process_target(self, detection_areas):
+		"""Runs detection. Every exit that was not requested with the stop event, including
+		import and initialization errors, sets the failed event"""
+		init_process_logging(self._logging_settings)
+		try:
+			self._run_detection()
+		except Exception as exc:
+			log.error(exc, exc_info=True)
+		finally:
+			if (not self._detection_stop_event.is_set()):
+				self._detection_failed_event.set()
+
+	def _run_detection(self, max_try=5):
+		from lib.rtpd.detector import Detector
+		from picamera.exc import PiCameraMMALError
+		from picamera import PiCamera
+		from picamera.array import PiRGBArray
+		from utils.detections import detection_arrays, foot_points
+		from utils.tracking import Tracker
+		from utils.zones import ZoneIndex, people_values
 		detection_initialized = False
 		camera: PiCamera
 		while not detection_initialized:
 			if (max_try <= 0):
 				log.error(
 					"Detection process: failed to initialize device for detection")
-				self._detection_failed_event.set()
 				return
 			max_try -= 1
 			try:
@@ -71,11 +136,10 @@ class RTPDProcess:
 				camera.framerate = self._camera_framerate
 				# Camera capture
 				rawCamCapture = PiRGBArray(
-					camera, size=self._camera_dimensions)
+					camera, size=self._capture_dimensions())
 				# Detector initialization
 				detector = Detector(self._model_loc, self._model_image_dimensions, "MYRIAD")
-				detector.set_detection_threshold(self._detection_threshold)
-				detector.set_detection_areas([self._detection_areas[0]])
+				detector.set_detection_threshold(self._detection_threshold.value * self._cache_threshold_ratio)
 				detection_initialized = True
 			except PiCameraMMALError as err:
 				log.warning(
@@ -95,24 +159,150 @@ class RTPDProcess:
 				max_try = 0
 				return
 
+		self._heartbeats.beat("capture")
 		self._detection_started_event.set()
 		log.debug("Detection process: PiCamera and MYRIAD device initialized")
-		for frame in camera.capture_continuous(rawCamCapture, format="bgr", use_video_port=True):
+		zones = None
+		line = None
+		threshold = self._detection_threshold.value
+		tracker = Tracker(entries=self._entries_total.value, exits=self._exits_total.value)
+		detection_cache = DetectionRing(self._max_cached_detections)
+		self._queue_lock = threading.Lock()
+		recount_thread = threading.Thread(target=self._recount_thread_target, args=(detection_cache,))
+		recount_thread.daemon = True
+		recount_thread.start()
+		profiler = LoopProfiler()
+		frame_timings = deque(maxlen=self._max_frame_timings)
+		last_detection = 0.0
+		while True:
+			last_frame = time.monotonic()
+			resize = self._model_image_dimensions if (self._preprocessing == "camera") else None
+			for frame in camera.capture_continuous(rawCamCapture, format="bgr", use_video_port=True, resize=resize):
+				self._heartbeats.beat("capture")
+				if (self._detection_stop_event.is_set()):
+					break
+				if (self._handle_commands(detector, profiler, frame_timings)):
+					# camera settings can only change while it is not capturing
+					rawCamCapture.truncate(0)
+					break
+				if (time.monotonic() - last_detection < self._detection_interval.value):
+					rawCamCapture.truncate(0)
+					continue
+				profiler.enable()
+				frame_start = last_detection = time.monotonic()
+				if (zones is not self._detection_areas.get()):
+					zones = self._detection_areas.get()
+					zone_index = ZoneIndex(zones)
+					detector.set_detection_areas(list(zones.values()) or [[]])
+				if (line is not self._counting_line.get()):
+					line = self._counting_line.get()
+					tracker.set_line(line)
+				if (threshold != self._detection_threshold.value):
+					threshold = self._detection_threshold.value
+					detector.set_detection_threshold(threshold * self._cache_threshold_ratio)
+				self._heartbeats.beat("inference")
+				detection_data = detector.detect_from_image(frame.array)
+				self._heartbeats.clear("inference")
+				boxes, confidences = detection_arrays(detection_data)
+				detection_cache.add(frame_start, boxes, confidences)
+				inference_end = time.monotonic()
+				rawCamCapture.truncate(0)
+				# assign all detections of the frame to the zones at once
+				points = foot_points(boxes[confidences >= threshold])
+				values = people_values(zone_index, points)
+				# follow people between frames to count entries, exits and dwell times
+				tracker.update(points, frame_start)
+				values.update(tracker.collect())
+				self._entries_total.value = values["entriesTotal"]
+				self._exits_total.value = values["exitsTotal"]
+				# load desired data into the queue, stamped with the monotonic capture time
+				self._detection_to_queue(DetectionRecord(frame_start, values))
+				frame_end = time.monotonic()
+				profiler.disable()
+				frame_timings.append(FrameTiming(frame_start,
+					round((frame_start - last_frame) * 1000, 1),
+					round((inference_end - frame_start) * 1000, 1),
+					round((frame_end - frame_start) * 1000, 1)))
+				last_frame = frame_end
 			if (self._detection_stop_event.is_set()):
 				break
-			detection_data = detector.detect_from_image(frame.array)
-			if (detector.get_detection_areas != [self._detection_areas[0]]):
-				detector.set_detection_areas([self._detection_areas[0]])
-			rawCamCapture.truncate(0)
-			# load desired data into the queue
-			self._detection_to_queue({"ts": int(time.time(
-			) * 1000), "values": {"numberOfPeople": len([person for person in detection_data if person['in_detection_area']])}})
+			camera.resolution = self._camera_dimensions
+			camera.framerate = self._camera_framerate
+			rawCamCapture = PiRGBArray(camera, size=self._capture_dimensions())
+		camera.close()
 
+	def _capture_dimensions(self):
+		if (self._preprocessing == "camera"):
+			return self._model_image_dimensions
+		return self._camera_dimensions
+
+	def _recount_thread_target(self, detection_cache):
+		"""Recounts people in the latest cached frame when zones or threshold change, so
+		the corrected count is sent without waiting for the next inference"""
+		from utils.detections import foot_points
+		from utils.zones import ZoneIndex, people_values
+		while not self._detection_stop_event.is_set():
+			if (not self._configuration_changed.wait(1)):
+				continue
+			self._configuration_changed.clear()
+			latest = detection_cache.latest()
+			if (latest is None):
+				continue
+			keep = latest.confidences >= self._detection_threshold.value
+			values = people_values(ZoneIndex(self._detection_areas.get()), foot_points(latest.boxes[keep]))
+			values["recomputed"] = True
+			self._detection_to_queue(DetectionRecord(time.monotonic(), values))
+			log.debug("Detection process: people recounted from cached detections")
+
+	def _handle_commands(self, detector, profiler, frame_timings):
+		"""Executes commands sent by the client and returns finished profiles. Returns True
+		when camera settings changed and capturing has to restart"""
+		reconfigure = False
+		summary = profiler.collect()
+		if (summary is not None):
+			self._command_result_put(("profile", summary))
+		while True:
+			try:
+				command, argument = self._command_queue.get_nowait()
+			except queue.Empty:
+				return reconfigure
+			if (command == "parameters"):
+				if ("framerate" in argument):
+					self._camera_framerate = argument["framerate"]
+					reconfigure = True
+				if ("resolution" in argument):
+					self._camera_dimensions = tuple(argument["resolution"])
+					reconfigure = True
+				log.info("Detection process: parameters changed: %s", argument)
+			elif (command == "profile"):
+				profiler.start(argument)
+			elif (command == "frame_timings"):
+				self._command_result_put(("frame_timings", list(frame_timings)))
+
+	def _command_result_put(self, result):
+		try:
+			self._command_results.put_nowait(result)
+		except queue.Full:
+			log.warning("Detection process: command result %s dropped", result[0])
+
+	def _send_command(self, command, argument):
+		try:
+			self._command_queue.put_nowait((command, argument))
+			return True
+		except queue.Full:
+			log.warning("Client: detection process does not take commands")
+			return False
 
 	def _detection_to_queue(self, detection):
-		if (self._detection_queue.full()):  # this deals with full queue I think
-			self._detection_queue.get()
-		self._detection_queue.put_nowait(detection)
+		with self._queue_lock:
+			if (self._detection_queue.full()):  # drop the oldest result to keep the newest
+				try:
+					self._detection_queue.get_nowait()
+				except queue.Empty:
+					pass
+				with self._dropped_detections.get_lock():
+					self._dropped_detections.value += 1
+			self._detection_queue.put_nowait(detection)
 		log.debug("Detection process: detection result loaded to queue")
 
 
@@ -122,25 +312,115 @@ class RTPDProcess:
 		self._detection_stop_event.clear()
 		self._detection_started_event.clear()
 		self._detection_failed_event.clear()
+		self._heartbeats.clear("capture", "inference")
 		self._detection_process = Process(
 			target=self._detection_process_target, args=(self._detection_areas,))
 		self._detection_process.daemon = True
 		log.info("Client: starting detection process")
 		self._detection_process.start()
+		self._started_at = time.monotonic()
 		self._detection_enabled = True
 
 
-	def stop_detection(self):
+	def _join_or_kill(self, timeout):
+		"""Waits for the detection process to stop and kills it if it hangs. Returns after
+		at most timeout + 2 seconds. Shared state is created again if the process was killed"""
+		self._detection_process.join(timeout)
+		if not self._detection_process.is_alive():
+			return
+		log.warning("Client: detection process does not stop, terminating")
+		self._detection_process.terminate()
+		self._detection_process.join(1)
+		if self._detection_process.is_alive():
+			self._detection_process.kill()
+			self._detection_process.join(1)
+		self._create_shared_state(self._detection_threshold.value, self._detection_interval.value,
+			self._dropped_detections.value, self._entries_total.value, self._exits_total.value)
+
+	def restart_detection(self, timeout=5):
+		"""Stops the detection process, killing it if it hangs, and starts a new one"""
+		if self._detection_process is not None:
+			log.warning("Client: restarting detection process")
+			self._detection_stop_event.set()
+			self._join_or_kill(timeout)
+			self._detection_process = None
+		self.start_detection()
+
+	def stop_detection(self, timeout=10):
 		if self._detection_process is None:
 			return False
 		self._detection_enabled = False
 		self._detection_stop_event.set()
 		if multiprocessing.current_process() != self._detection_process:
 			log.info("Client: stopping detection process")
-			self._detection_process.join()
+			self._join_or_kill(timeout)
 			self._detection_process = None
 			log.info("Client: detection process stopped")
 
+	def parameters(self):
+		return {"detection_threshold": self._detection_threshold.value,
+			"framerate": self._camera_framerate,
+			"resolution": list(self._camera_dimensions)}
+
+	def set_parameters(self, parameters):
+		"""Changes detection parameters of the running detection process and of any
+		detection process started later"""
+		if ("detection_threshold" in parameters):
+			self._detection_threshold.value = parameters["detection_threshold"]
+			self._configuration_changed.set()
+		if ("framerate" in parameters):
+			self._camera_framerate = parameters["framerate"]
+		if ("resolution" in parameters):
+			self._camera_dimensions = tuple(parameters["resolution"])
+		if (self._detection_process is not None):
+			self._send_command("parameters", parameters)
+
+	def configuration_changed(self):
+		"""Notifies the running detection process that zones changed"""
+		self._configuration_changed.set()
+
+	def request_profile(self, seconds):
+		if (self._detection_process is None):
+			return False
+		return self._send_command("profile", seconds)
+
+	def request_frame_timings(self):
+		if (self._detection_process is None):
+			return False
+		return self._send_command("frame_timings", None)
+
+	def command_result(self):
+		"""Returns the next (command, result) pair from the detection process, or None"""
+		try:
+			return self._command_results.get_nowait()
+		except queue.Empty:
+			return None
+
+	def detection_queue(self):
+		return self._detection_queue
+
+	def alive(self):
+		return self._detection_process is not None and self._detection_process.is_alive()
+
+	def exitcode(self):
+		return self._detection_process.exitcode if self._detection_process is not None else None
+
+	def starting_for(self):
+		"""Seconds since the detection process was started if it did not finish
+		initialization yet, otherwise None"""
+		if (self._detection_process is None or self.started()):
+			return None
+		return time.monotonic() - self._started_at
+
+	def pid(self):
+		return self._detection_process.pid if self._detection_process is not None else None
+
+	def set_detection_interval(self, interval):
+		self._detection_interval.value = interval
+
+	def dropped_detections(self):
+		return self._dropped_detections.value
+
 	def enabled(self):
 		return self._detection_enabled
 
@@ -0,0 +1,126 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import argparse
+import threading
+import logging
+import time
+import sys
+import os
+
+# Import from local folders
+sys.path.append('./utils')
+from utils.tb_device_mqtt import ProvisionClient, TBDeviceMqttClient, TBTimeoutException
+from utils.credentials import CredentialsStore
+
+load_dotenv()
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+
+class FleetProvisioner:
+    """Provisions many devices concurrently. Every worker thread keeps its own provisioning
+    connection open and reuses it for the devices it handles, since provisioning responses
+    carry no request id and only one request can be outstanding per connection."""
+
+    def __init__(self, host, port, provision_device_key, provision_device_secret, store: CredentialsStore,
+                 tls=False, timeout=10, retries=3, retry_delay=1):
+        self._host = host
+        self._port = port
+        self._provision_device_key = provision_device_key
+        self._provision_device_secret = provision_device_secret
+        self._store = store
+        self._tls = tls
+        self._timeout = timeout
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._connections = threading.local()
+        self._opened = []
+        self._opened_lock = threading.Lock()
+
+    def _connection(self) -> ProvisionClient:
+        client = getattr(self._connections, 'client', None)
+        if client is None:
+            client = ProvisionClient(self._host, self._port)
+            self._connections.client = client
+            with self._opened_lock:
+                self._opened.append(client)
+        if not client.is_connected():
+            client.open(tls=self._tls, timeout=self._timeout)
+        return client
+
+    def provision(self, device_name) -> bool:
+        """Provisions a single device unless the store already has its token"""
+        if self._store.get(device_name):
+            log.info("Fleet: %s already provisioned", device_name)
+            return True
+        request = TBDeviceMqttClient.provision_request(
+            self._provision_device_key, self._provision_device_secret, device_name)
+        for attempt in range(1, self._retries + 1):
+            try:
+                token = self._connection().request(request, self._timeout)
+                if token:
+                    self._store.set(device_name, token)
+                    log.info("Fleet: %s provisioned", device_name)
+                    return True
+                log.error("Fleet: %s rejected by the server", device_name)
+                return False
+            except (TBTimeoutException, OSError) as err:
+                log.warning("Fleet: %s attempt %d/%d failed: %s", device_name, attempt, self._retries, err)
+                self._connections.client.close()
+                time.sleep(min(self._retry_delay * 2 ** attempt, 30))
+        return False
+
+    def provision_all(self, device_names, pool_size=8):
+        """Returns the names of devices that could not be provisioned"""
+        try:
+            with ThreadPoolExecutor(max_workers=pool_size) as executor:
+                results = list(executor.map(self.provision, device_names))
+        finally:
+            with self._opened_lock:
+                for client in self._opened:
+                    client.close()
+        return [name for name, provisioned in zip(device_names, results) if not provisioned]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Provision a batch of devices in ThingsBoard")
+    parser.add_argument('devices', help="file with one device name per line")
+    parser.add_argument('--host', default="tb.yerzham.com")
+    parser.add_argument('--port', type=int, default=8883)
+    parser.add_argument('--no-tls', action='store_true')
+    parser.add_argument('--store', default='credentials.json', help="credentials file to update")
+    parser.add_argument('--pool-size', type=int, default=8, help="number of concurrent connections")
+    parser.add_argument('--timeout', type=float, default=10, help="seconds to wait for each response")
+    parser.add_argument('--retries', type=int, default=3)
+    args = parser.parse_args()
+
+    with open(args.devices) as devices_file:
+        device_names = [line.strip() for line in devices_file if line.strip()]
+    provisioner = FleetProvisioner(args.host, args.port,
+                                   os.getenv('PROVISION_DEVICE_KEY'), os.getenv('PROVISION_DEVICE_SECRET'),
+                                   CredentialsStore(args.store, legacy_filename=None),
+                                   tls=not args.no_tls, timeout=args.timeout, retries=args.retries)
+    failed = provisioner.provision_all(device_names, args.pool_size)
+    if failed:
+        log.error("Fleet: %d of %d devices failed: %s", len(failed), len(device_names), ", ".join(failed))
+        sys.exit(1)
+    log.info("Fleet: %d devices provisioned", len(device_names))
+
+
+if __name__ == '__main__':
+    main()
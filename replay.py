@@ -0,0 +1,211 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from concurrent.futures import ProcessPoolExecutor
+from json import load
+import argparse
+import hashlib
+import logging
+import csv
+import sys
+import os
+
+import numpy as np
+
+# Import from local folders
+sys.path.append('./utils')
+sys.path.append('./libs')
+from utils.detections import detection_arrays, foot_points
+from utils.zones import ZoneIndex, parse_detection_bounds, zone_telemetry_key
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = ('.mp4', '.h264', '.avi', '.mkv', '.mov')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+# Changes with the format of cached detections, so older caches are not used
+CACHE_VERSION = 2
+
+# Detector of a worker process, created once by the pool initializer
+_detector = None
+
+
+def find_recordings(directory):
+    """Video files in the directory, and subdirectories holding image frames (sorted by
+    name) which are replayed as one recording each"""
+    recordings = []
+    for entry in sorted(os.listdir(directory)):
+        path = os.path.join(directory, entry)
+        if (os.path.isfile(path) and entry.lower().endswith(VIDEO_EXTENSIONS)):
+            recordings.append(path)
+        elif (os.path.isdir(path) and any(name.lower().endswith(IMAGE_EXTENSIONS) for name in os.listdir(path))):
+            recordings.append(path)
+    return recordings
+
+
+def recording_frames(path, fps):
+    """Yields (time in seconds, BGR frame) sampled at fps frames per second, the rate the
+    device camera runs at"""
+    import cv2
+    if (os.path.isdir(path)):
+        images = sorted(name for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS))
+        for i, name in enumerate(images):
+            yield i / fps, cv2.imread(os.path.join(path, name))
+        return
+    capture = cv2.VideoCapture(path)
+    source_fps = capture.get(cv2.CAP_PROP_FPS) or fps
+    step = max(source_fps / fps, 1.0)
+    index = 0
+    next_index = 0.0
+    while True:
+        ok, frame = capture.read()
+        if (not ok):
+            break
+        if (index >= next_index):
+            yield index / source_fps, frame
+            next_index += step
+        index += 1
+    capture.release()
+
+
+def cache_filename(cache_dir, path, model_loc, fps, cache_threshold):
+    """Detector outputs are cached per recording, model and sampling settings"""
+    stat = os.stat(path)
+    key = "%d|%s|%d|%f|%s|%f|%f" % (CACHE_VERSION, os.path.abspath(path), stat.st_size, stat.st_mtime,
+                                      model_loc[0], fps, cache_threshold)
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".npz")
+
+
+def _init_worker(model_loc, model_image_dimensions, device, cache_threshold):
+    global _detector
+    from lib.rtpd.detector import Detector
+    _detector = Detector(model_loc, model_image_dimensions, device)
+    _detector.set_detection_threshold(cache_threshold)
+    _detector.set_detection_areas([[]])
+
+
+def detect_recording(path, cache_file, fps):
+    """Runs the detector over a recording and stores all boxes and confidences"""
+    times, boxes, confidences, frames = [], [], [], []
+    for i, (ts, frame) in enumerate(recording_frames(path, fps)):
+        frame_boxes, frame_confidences = detection_arrays(_detector.detect_from_image(frame))
+        times.append(ts)
+        boxes.append(frame_boxes)
+        confidences.append(frame_confidences)
+        frames.append(np.full(len(frame_boxes), i, dtype=np.int32))
+    # The cache is written to a temporary file and renamed, so an interrupted run never
+    # leaves a truncated cache file behind
+    temp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    with open(temp_file, 'wb') as cache:
+        np.savez_compressed(cache,
+                            times=np.array(times, dtype=np.float32),
+                            boxes=np.concatenate(boxes) if boxes else np.zeros((0, 4), dtype=np.float32),
+                            confidences=np.concatenate(confidences) if confidences else np.zeros(0, dtype=np.float32),
+                            frames=np.concatenate(frames) if frames else np.zeros(0, dtype=np.int32))
+    os.replace(temp_file, cache_file)
+    log.info("Replay: %s: %d frames detected", path, len(times))
+    return cache_file
+
+
+def count_timeline(detections, threshold, zone_index: ZoneIndex):
+    """People counts of every frame for one threshold and zone set. All detections of the
+    recording go through the zone index at once. numberOfPeople counts people in any zone,
+    or all people when there are no zones"""
+    times = detections["times"]
+    keep = detections["confidences"] >= threshold
+    frames = detections["frames"][keep]
+    membership = zone_index.membership(foot_points(detections["boxes"][keep]))
+    counted = membership.any(axis=1) if zone_index.names() else np.ones(len(frames), dtype=bool)
+    timeline = {"time": times,
+                "numberOfPeople": np.bincount(frames[counted], minlength=len(times))}
+    for i, name in enumerate(zone_index.names()):
+        timeline[zone_telemetry_key(name)] = np.bincount(frames[membership[:, i]], minlength=len(times))
+    return timeline
+
+
+def write_timeline(filename, timeline):
+    with open(filename, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(timeline.keys())
+        writer.writerows(zip(*timeline.values()))
+
+
+def read_zones(filename):
+    with open(filename) as zones_file:
+        zones = parse_detection_bounds(load(zones_file))
+    if (zones is None):
+        raise ValueError("%s is not a valid detectionBounds value" % filename)
+    return zones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded footage through the detector and "
+                                                 "produce people count timelines")
+    parser.add_argument('recordings', help="directory of videos or of frame directories")
+    parser.add_argument('--zones', nargs='*', default=[],
+                        help="JSON files with detectionBounds values, no bounds if omitted")
+    parser.add_argument('--thresholds', nargs='+', type=float, default=[50],
+                        help="detection thresholds to evaluate")
+    parser.add_argument('--cache-threshold', type=float, default=10,
+                        help="lowest threshold kept in the cache, in percent")
+    parser.add_argument('--fps', type=float, default=1, help="frames per second to sample")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--device', default="CPU", help="inference device")
+    parser.add_argument('--model', nargs=2, default=["models/pd_retail_13/FP16/model.xml",
+                                                     "models/pd_retail_13/FP16/model.bin"])
+    parser.add_argument('--model-dimensions', nargs=2, type=int, default=[544, 320])
+    parser.add_argument('--cache-dir', default='.replay_cache')
+    parser.add_argument('--output', default='replay_output')
+    args = parser.parse_args()
+
+    if (min(args.thresholds) < args.cache_threshold):
+        parser.error("thresholds must not be below --cache-threshold")
+    os.makedirs(args.cache_dir, exist_ok=True)
+    os.makedirs(args.output, exist_ok=True)
+    model_loc = tuple(args.model)
+    zone_sets = {os.path.splitext(os.path.basename(name))[0]: read_zones(name) for name in args.zones}
+    zone_sets = zone_sets or {"all": {}}
+
+    # Run inference only for recordings without cached detector outputs
+    cache_files = {path: cache_filename(args.cache_dir, path, model_loc, args.fps, args.cache_threshold)
+                   for path in find_recordings(args.recordings)}
+    missing = [path for path, cache_file in cache_files.items() if not os.path.exists(cache_file)]
+    log.info("Replay: %d recordings, %d cached", len(cache_files), len(cache_files) - len(missing))
+    if (missing):
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                 initargs=(model_loc, tuple(args.model_dimensions), args.device,
+                                           args.cache_threshold)) as executor:
+            list(executor.map(detect_recording, missing, [cache_files[path] for path in missing],
+                              [args.fps] * len(missing)))
+
+    # Threshold and zone sweeps only filter cached detections
+    for path, cache_file in cache_files.items():
+        # Members of an npz file are decompressed on every access, so they are loaded once
+        with np.load(cache_file) as cached:
+            detections = dict(cached)
+        recording = os.path.splitext(os.path.basename(path.rstrip(os.sep)))[0]
+        for zones_name, zones in zone_sets.items():
+            zone_index = ZoneIndex(zones)
+            for threshold in args.thresholds:
+                timeline = count_timeline(detections, threshold, zone_index)
+                write_timeline(os.path.join(args.output, "%s_%s_%g.csv" % (recording, zones_name, threshold)),
+                               timeline)
+                log.info("Replay: %s, zones %s, threshold %g: mean %.2f, max %d people", recording, zones_name,
+                         threshold, timeline["numberOfPeople"].mean() if len(timeline["time"]) else 0,
+                         timeline["numberOfPeople"].max(initial=0))
+
+
+if __name__ == '__main__':
+    main()
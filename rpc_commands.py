@@ -0,0 +1,157 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from json import dumps
+from threading import Lock
+import logging
+
+from utils.profiling import LoopProfiler
+from utils.tb_device_mqtt import TBDeviceMqttClient
+from utils.timing import WallClock
+from detection_process import RTPDProcess
+log = logging.getLogger(__name__)
+
+MAX_PROFILE_SECONDS = 120
+
+
+class RPCCommands:
+    """Server-side RPC commands for tuning and diagnosing a device without restarting it.
+    Requests arrive on the MQTT network thread and are answered right away, except for
+    frame timings, which are answered from poll() once they are ready. Profiles take
+    longer than the RPC timeout, so they are acknowledged right away and sent as
+    telemetry from poll()."""
+
+    def __init__(self, client: TBDeviceMqttClient, rtpd_process: RTPDProcess, metrics, clock: WallClock):
+        self._client = client
+        self._clock = clock
+        self._process = rtpd_process
+        self._metrics = metrics
+        self.network_profiler = LoopProfiler()
+        # Request ids waiting for a result, keyed by the result source
+        self._waiting = {"frame_timings": []}
+        self._lock = Lock()
+        self._methods = {
+            "getDetectionParameters": self._get_detection_parameters,
+            "setDetectionParameters": self._set_detection_parameters,
+            "getMetrics": self._get_metrics,
+            "getFrameTimings": self._get_frame_timings,
+            "profile": self._profile,
+        }
+
+    def _reply(self, request_id, response):
+        self._client.send_rpc_reply(request_id, dumps(response))
+
+    def handle_request(self, _client, request_id, request):
+        """Server side RPC request handler for TBDeviceMqttClient"""
+        if (type(request) is not dict):
+            request = {}
+        method = request.get("method")
+        params = request.get("params")
+        log.info("RPC: %s %s", method, params)
+        if (type(method) is not str or method not in self._methods):
+            self._reply(request_id, {"error": "unknown method %s" % method})
+            return
+        if (params is None):
+            params = {}
+        if (type(params) is not dict):
+            self._reply(request_id, {"error": "params must be an object"})
+            return
+        try:
+            response = self._methods[method](request_id, params)
+        except (ValueError, TypeError, KeyError) as err:
+            response = {"error": str(err)}
+        if (response is not None):
+            self._reply(request_id, response)
+
+    def _wait_for(self, source, request_id):
+        with self._lock:
+            self._waiting[source].append(request_id)
+
+    def _answer(self, source, response):
+        with self._lock:
+            request_ids, self._waiting[source] = self._waiting[source], []
+        for request_id in request_ids:
+            self._reply(request_id, response)
+
+    def poll(self):
+        """Answers requests whose results became available. Called by the network thread"""
+        summary = self.network_profiler.collect()
+        if (summary is not None):
+            self._send_profile("network", summary)
+        result = self._process.command_result()
+        while (result is not None):
+            source, response = result
+            if (source == "profile"):
+                self._send_profile("detection", response)
+            else:
+                response = [timing.as_dict(self._clock.to_wall_ms(timing.mono)) for timing in response]
+                self._answer(source, response)
+            result = self._process.command_result()
+
+    def _send_profile(self, target, summary):
+        self._client.send_telemetry({"profileTarget": target, "profileIterations": summary["iterations"],
+                                     "profileStats": summary["stats"]}, 1)
+
+    def _get_detection_parameters(self, _request_id, _params):
+        return self._process.parameters()
+
+    def _set_detection_parameters(self, _request_id, params):
+        parameters = {}
+        if ("detection_threshold" in params):
+            threshold = params["detection_threshold"]
+            if (type(threshold) not in (int, float) or not 0 < threshold <= 100):
+                raise ValueError("detection_threshold must be a percentage between 0 and 100")
+            parameters["detection_threshold"] = threshold
+        if ("framerate" in params):
+            framerate = params["framerate"]
+            if (type(framerate) not in (int, float) or not 0 < framerate <= 30):
+                raise ValueError("framerate must be a number between 0 and 30")
+            parameters["framerate"] = framerate
+        if ("resolution" in params):
+            resolution = params["resolution"]
+            if (type(resolution) is not list or len(resolution) != 2 or
+                    not all(type(n) is int and n > 0 for n in resolution)):
+                raise ValueError("resolution must be [width, height]")
+            parameters["resolution"] = resolution
+        if (not parameters):
+            raise ValueError("no detection parameters given")
+        self._process.set_parameters(parameters)
+        return self._process.parameters()
+
+    def _get_metrics(self, _request_id, _params):
+        return self._metrics()
+
+    def _get_frame_timings(self, request_id, _params):
+        if (not self._process.request_frame_timings()):
+            return {"error": "detection process is not running"}
+        self._wait_for("frame_timings", request_id)
+
+    def _profile(self, request_id, params):
+        """Starts a cProfile capture of the network or detection loop for the given number
+        of seconds. The zlib compressed, base64 encoded pstats summary is sent as telemetry
+        when the capture ends"""
+        target = params.get("target", "detection")
+        seconds = params.get("seconds", 10)
+        if (type(seconds) not in (int, float) or not 0 < seconds <= MAX_PROFILE_SECONDS):
+            raise ValueError("seconds must be between 0 and %d" % MAX_PROFILE_SECONDS)
+        if (target == "network"):
+            if (not self.network_profiler.active()):
+                self.network_profiler.start(seconds)
+        elif (target == "detection"):
+            if (not self._process.request_profile(seconds)):
+                return {"error": "detection process is not running"}
+        else:
+            raise ValueError("target must be network or detection")
+        return {"target": target, "seconds": seconds, "started": True}
@@ -0,0 +1,437 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+import multiprocessing
+from dotenv import load_dotenv
+from typing import Tuple
+import threading
+import hashlib
+import queue
+import logging
+import time
+import sys
+import os
+
+# Import from local folders
+sys.path.append('./utils')
+sys.path.append('./libs')
+from utils.tb_device_mqtt import RESULT_CODES, TBDeviceMqttClient, TBTimeoutException
+from utils.credentials import CredentialsStore
+from utils.config_cache import ConfigCache
+from utils.logs import parse_levels, setup_logging
+from utils.memory import rss_kb
+from utils.publish_pipeline import PublishPipeline
+from utils.shared_json import SharedJSON
+from utils.timing import WallClock
+from utils.watchdog import Heartbeats
+from utils.zone_config import parse_detection_bounds
+from detection_process import RTPDProcess
+from rpc_commands import RPCCommands
+from supervisor import Supervisor
+
+# Prepare environment variables and logger
+load_dotenv()
+log = logging.getLogger(__name__)
+# Perpare server connection variables
+SERVER = ("tb.yerzham.com", 8883)
+use_tls = True
+PROVISION_DEVICE_KEY = os.getenv('PROVISION_DEVICE_KEY')
+PROVISION_DEVICE_SECRET = os.getenv('PROVISION_DEVICE_SECRET')
+DEVICE_NAME = os.getenv('DEVICE_NAME')
+CONFIGURATION_KEYS = ["detectionEnabled", "detectionBounds", "countingLine"]
+# Low-memory profile for 512 MB devices
+LOW_MEMORY = os.getenv('LOW_MEMORY', '').lower() in ('1', 'true', 'yes')
+MEMORY_REPORT_INTERVAL = 60  # seconds
+PREPROCESSING = os.getenv('PREPROCESSING', 'detector')
+
+
+class RTPDClient:
+    def _obtain_token(self, credentials_filename='credentials.json'):
+        """Obtain token via file storing credentials. If not found, use environment variable provisioning 
+        credentials to request a new device token. Saves the device token into a file for a later use."""
+        store = CredentialsStore(credentials_filename)
+        token = store.get(DEVICE_NAME)
+        if (not token):
+            try:
+                token = TBDeviceMqttClient.provision(
+                    self._server[0], PROVISION_DEVICE_KEY, PROVISION_DEVICE_SECRET, self._server[1], DEVICE_NAME, tls=use_tls)
+            except (TBTimeoutException, OSError) as err:
+                # OSError covers refused connections and TLS failures (ssl.SSLError)
+                log.error("Client: provisioning failed: %s", err)
+                token = ''
+            if (token):
+                store.set(DEVICE_NAME, token)
+        return token
+
+    def __init__(self, server: Tuple[str, int], credentials_filename='credentials.json', low_memory=False):
+        """Initialize the RTPD Client. Requires server information and a file where
+        where credentials are stored. If credentials do not exist, client requires 
+        PROVISION_DEVICE_KEY, PROVISION_DEVICE_SECRET, DEVICE_NAME environment 
+        variables defined. The low memory profile uses smaller buffers, camera frames
+        and caches, and skips validation of outgoing payloads."""
+        self._server = server
+        self._token = self._obtain_token(credentials_filename)
+
+        if (not self._token):
+            raise Exception("Unable to obtain device token")
+
+        # A stable client id with a persistent session keeps subscriptions across reconnects
+        client_id = 'rtpd-' + hashlib.sha1(self._token.encode()).hexdigest()[:16]
+        self._client = TBDeviceMqttClient(server[0], self._token, server[1], 1,
+                                          client_id=client_id, clean_session=False,
+                                          validate_payloads=not low_memory)
+
+        # Client operation status variables
+        self._connected = False
+        self._operating = False
+        self._configured = False
+        self._detection_enabled = False
+        self._detecting = False
+        
+        # Client configuration and configuration validation
+        self._config = None
+        self._config_cache = ConfigCache()
+        self._config_stale = True
+        self._detectionEnabled_valid = False
+        self._detectionBounds_valid = False
+        self._countingLine_valid = False
+
+        # Detection variables
+        self._max_detections_to_store = 10 if low_memory else 50  # buffer size
+        self._clock = WallClock()
+        self._publisher = PublishPipeline(self._client, self._max_detections_to_store, self._clock,
+                                          max_journal_records=30 if low_memory else 120)
+        # Zones and counting line shared with the detection process
+        self._detection_areas = SharedJSON({})
+        self._counting_line = SharedJSON([])
+        self._memory_reported = 0.0
+
+        # Client network thread and detection process
+        self._connection_thread = None
+        self._heartbeats = Heartbeats(("capture", "inference", "network"))
+        self._RTPD_process = RTPDProcess(self._max_detections_to_store, self._detection_areas, self._counting_line,
+            self._heartbeats,
+            detection_threshold=50, 
+            model_image_dimensions=(544, 320), 
+            model_loc=("models/pd_retail_13/FP16/model.xml", "models/pd_retail_13/FP16/model.bin"),
+            camera_dimensions=(1024, 576) if low_memory else (1920, 1080),
+            max_cached_detections=10 if low_memory else 30,
+            max_frame_timings=30 if low_memory else 100,
+            preprocessing=PREPROCESSING)
+        self._rpc = RPCCommands(self._client, self._RTPD_process, self._metrics, self._clock)
+        self._client.set_server_side_rpc_request_handler(self._rpc.handle_request)
+
+        # Supervisor restarts a hanging or failed detection process. The lock keeps it from
+        # restarting the process while the network thread starts or stops it
+        self._process_lock = threading.Lock()
+        self._supervisor = Supervisor(self._RTPD_process, self._heartbeats, self._process_lock,
+                                      self._publisher.send_status)
+
+        # Start with the cached configuration until the server confirms it. The client is
+        # not connected yet, the status is sent after the connect
+        if (self._config_cache.values()):
+            self._apply_configuration(send_status=False)
+
+    def _send_configuration_validity(self, send_status=True):
+        self._configured = (self._detectionEnabled_valid and self._detectionBounds_valid and
+                            self._countingLine_valid)
+        if (send_status):
+            self._publisher.send_status({'configured': self._configured})
+        else:
+            self._publisher.update_status({'configured': self._configured})
+
+    def _send_detection_status(self, detection_status):
+        self._detecting = detection_status
+        self._publisher.send_status({'detecting': detection_status})
+
+    def _validate_and_read_detectionBounds(self, attributes):
+        """Reads detection zones. Returns a dictionary of zone names to raw polygons"""
+        try:
+            zones = parse_detection_bounds(attributes["detectionBounds"])
+        except KeyError:
+            zones = None
+        if (zones is not None and not self._detection_areas.fits(zones)):
+            log.warning("Client: detectionBounds are too large")
+            zones = None
+        self._detectionBounds_valid = zones is not None
+        return zones if zones is not None else {}
+
+    def _validate_and_read_countingLine(self, attributes):
+        """Reads the line used to count entries and exits. Attribute countingLine is a list
+        of two points, or an empty object or missing when entries and exits are not counted"""
+        line = attributes.get("countingLine", {})
+        if (type(line) is list and len(line) == 2 and
+                all(type(n) is dict and 'x' in n and 'y' in n and
+                    n['x'] <= 1 and n['x'] >= 0 and
+                    n['y'] <= 1 and n['y'] >= 0 for n in line)):
+            self._countingLine_valid = True
+            return [[point['x'], point['y']] for point in line]
+        self._countingLine_valid = type(line) is dict and not line
+        return []
+
+    def _validate_and_read_detectionEnabled(self, attributes):
+        try:
+            if (type(attributes["detectionEnabled"]) is bool):
+                self._detectionEnabled_valid = True
+                return attributes["detectionEnabled"]
+            else:
+                self._detectionEnabled_valid = False
+                return False
+        except KeyError:
+            self._detectionEnabled_valid = False
+            return False
+
+    def _validate_and_read_attributes(self, attributes):
+        attributes["shared"]["detectionEnabled"] = self._validate_and_read_detectionEnabled(
+            attributes["shared"])
+        attributes["shared"]["detectionBounds"] = self._validate_and_read_detectionBounds(
+            attributes["shared"])
+        attributes["shared"]["countingLine"] = self._validate_and_read_countingLine(
+            attributes["shared"])
+        return attributes
+
+    def _handle_detectionEnabled_change(self, _client, result, exception):
+        """Callback function that handles received detectionEnabled attribute from an
+        attribute subscription"""
+        if exception is not None:
+            raise exception
+        self._config_cache.update(
+            {key: value for key, value in result.items() if key in CONFIGURATION_KEYS})
+        self._config["shared"]["detectionEnabled"] = self._validate_and_read_detectionEnabled(
+            result)
+        self._send_configuration_validity()
+
+    def _handle_detectionBounds_change(self, _client, result, exception):
+        """Callback function that handles received detectionBounds attribute from an
+        attribute subscription"""
+        if exception is not None:
+            raise exception
+        self._config_cache.update(
+            {key: value for key, value in result.items() if key in CONFIGURATION_KEYS})
+        self._config["shared"]["detectionBounds"] = self._validate_and_read_detectionBounds(
+            result)
+        self._detection_areas.set(self._config["shared"]["detectionBounds"])
+        self._RTPD_process.configuration_changed()
+        self._send_configuration_validity()
+
+    def _handle_countingLine_change(self, _client, result, exception):
+        """Callback function that handles received countingLine attribute from an
+        attribute subscription"""
+        if exception is not None:
+            raise exception
+        self._config_cache.update(
+            {key: value for key, value in result.items() if key in CONFIGURATION_KEYS})
+        self._config["shared"]["countingLine"] = self._validate_and_read_countingLine(
+            result)
+        self._counting_line.set(self._config["shared"]["countingLine"])
+        self._send_configuration_validity()
+
+    def _apply_configuration(self, send_status=True):
+        """Validates the cached configuration and shares it with the detection process"""
+        self._config = self._validate_and_read_attributes(
+            {"shared": self._config_cache.values()})
+        self._detection_areas.set(self._config["shared"]["detectionBounds"])
+        self._RTPD_process.configuration_changed()
+        self._counting_line.set(self._config["shared"]["countingLine"])
+        self._send_configuration_validity(send_status)
+
+    def _handle_received_attributes(self, _client, result, exception):
+        """Callback function that handles received attributes from a configuration request.
+        Configuration is only re-applied if some attribute changed since it was cached"""
+        if exception is not None:
+            log.warning("Network: configuration request failed: %s", exception)
+            self._config_stale = True
+            return
+        changed = self._config_cache.update(result.get("shared", {}), CONFIGURATION_KEYS)
+        if (self._config is None or changed):
+            log.info("Client: configuration changed: %s", changed)
+            self._apply_configuration()
+
+    def _request_configuration(self):
+        """Sends request to refresh attribute values. The cached configuration stays in use
+        until the response arrives"""
+        self._config_stale = False
+        self._client.request_attributes(
+            [], CONFIGURATION_KEYS, callback=self._handle_received_attributes)
+
+    def _connected_handler(self, client, userdata, flags, result_code, *extra_params):
+        """Callback function called after ThingsBoard client is connected to MQTTS port.
+        If there is a connection error, it marks the configuration as stale, so it is
+        refreshed in case configuration was changed while it was temporarily disconnected"""
+        if (result_code != 0):
+            log.error("Network: connection failed: %d, %s",
+                      result_code, RESULT_CODES.get(result_code, 'unknown'))
+            self._connected = False
+            self._config_stale = True
+            self._publisher.connection_lost()
+        elif (result_code == 0):
+            self._connected = True
+            self._publisher.connected()
+
+    def _publish_detection(self):
+        """Moves one detection result from the detection queue to the MQTT client. Results
+        stay in the bounded queue while the client is disconnected or its in-flight window
+        is full, and the detection rate is adjusted to the backlog"""
+        detection_queue = self._RTPD_process.detection_queue()
+        queue_depth = detection_queue.qsize()
+        self._RTPD_process.set_detection_interval(
+            self._publisher.detection_interval(queue_depth))
+        if (not self._publisher.ready()):
+            time.sleep(0.1)
+            return
+        self._publisher.resend_journal()
+        try:
+            detection_result = detection_queue.get(timeout=1)
+        except queue.Empty:
+            return
+        log.debug('Network: sending detection result')
+        self._publisher.publish(detection_result, queue_depth,
+                                self._RTPD_process.dropped_detections())
+
+    def _metrics(self):
+        """Snapshot of the client state for the getMetrics RPC command"""
+        metrics = {"connected": self._connected, "configured": self._configured,
+                   "detectionEnabled": self._RTPD_process.enabled(), "detecting": self._detecting}
+        metrics.update(self._publisher.metrics(self._RTPD_process.detection_queue().qsize(),
+                                               self._RTPD_process.dropped_detections()))
+        metrics.update(self._memory_usage())
+        return metrics
+
+    def _memory_usage(self):
+        """Resident set size (kB) of the client and of the detection process"""
+        usage = {"clientRssKb": rss_kb()}
+        if (self._RTPD_process.pid() is not None):
+            usage["detectionRssKb"] = rss_kb(self._RTPD_process.pid())
+        return usage
+
+    def _report_memory_usage(self):
+        if (self._connected and time.monotonic() - self._memory_reported > MEMORY_REPORT_INTERVAL):
+            self._memory_reported = time.monotonic()
+            usage = {key: value for key, value in self._memory_usage().items() if value is not None}
+            log.debug("Client: memory usage %s", usage)
+            self._publisher.send_status(usage)
+
+    def _connection_thread_target(self):
+        """Network connection thread that controls the client depending on network connectivity 
+        results and device status. Attributes detectionEnabled and detectionBounds influence
+        the device behaviour, while device status triggers sending updates to the server"""
+        self._client.subscribe_to_attribute(
+            'detectionEnabled', self._handle_detectionEnabled_change)
+        self._client.subscribe_to_attribute(
+            'detectionBounds', self._handle_detectionBounds_change)
+        self._client.subscribe_to_attribute(
+            'countingLine', self._handle_countingLine_change)
+        while (self._operating):
+            self._heartbeats.beat("network")
+            self._rpc.network_profiler.enable()
+            self._connection_step()
+            self._rpc.network_profiler.disable()
+            self._rpc.poll()
+            self._report_memory_usage()
+
+    def _connection_step(self):
+        """Single iteration of the network connection thread"""
+        # Check detection process status updates
+        if (self._RTPD_process.started() and not self._detecting):
+            self._send_detection_status(True)
+        if (self._RTPD_process.stopped() and self._detecting):
+            self._send_detection_status(False)
+        if (self._RTPD_process.failed() and self._detecting):
+            # the supervisor restarts the detection process
+            self._send_detection_status(False)
+        
+        # If client configuration may be outdated, refresh it
+        if (self._config_stale and self._connected == True):
+            self._request_configuration()
+        # Wait for the first configuration, otherwise either idle or send detection data
+        if (self._config == None):
+            time.sleep(0.25)
+        elif (self._config != None and self._config["shared"]["detectionEnabled"] == False):
+            if (self._RTPD_process.enabled() == True):
+                log.info("Client: detection disabled")
+                with self._process_lock:
+                    self._RTPD_process.stop_detection()
+            else:
+                log.debug('Network: idle')
+                self._publisher.heartbeat()
+                time.sleep(1.5)
+        elif (self._config != None and self._config["shared"]["detectionEnabled"] == True):
+            if (self._RTPD_process.enabled() == False):
+                log.info("Client: detection enabled")
+                with self._process_lock:
+                    self._RTPD_process.start_detection()
+            else:
+                if (self._detecting):
+                    self._publish_detection()
+
+    def _start_connection(self):
+        if self._connection_thread is not None:
+            return False
+        self._connection_thread = threading.Thread(
+            target=self._connection_thread_target)
+        self._connection_thread.daemon = True
+        self._operating = True
+        log.info("Client: starting connection thread")
+        self._connection_thread.start()
+
+    def _stop_connection(self):
+        if self._connection_thread is None:
+            return False
+        self._operating = False
+        if threading.current_thread() != self._connection_thread:
+            log.info("Client: stopping connection thread")
+            self._connection_thread.join(30)
+            self._connection_thread = None
+            log.info("Client: connection thread stopped")
+        if (not self._client.stopped):
+            self._client.stop()
+
+    def stop(self):
+        self._supervisor.stop()
+        self._stop_connection()
+        self._RTPD_process.stop_detection()
+
+    def stopped(self):
+        return not self._operating or self._client.stopped or self._supervisor.gave_up()
+
+    def failed(self):
+        """Whether the supervisor gave up on the client"""
+        return self._supervisor.gave_up()
+
+    def start(self):
+        self._client.connect(
+            tls=use_tls, callback=self._connected_handler, keepalive=30)
+        self._start_connection()
+        self._supervisor.start()
+
+
+def main():
+    """Runs the client until it stops. Returns the exit code, 1 when the client failed so
+    that a service manager restarts it"""
+    setup_logging(os.getenv('LOG_LEVEL', 'INFO'), parse_levels(os.getenv('LOG_LEVELS')))
+    if (LOW_MEMORY):
+        # the detection process starts from a fresh interpreter instead of a copy of the client
+        multiprocessing.set_start_method('spawn')
+    rtpd_client = RTPDClient(SERVER, low_memory=LOW_MEMORY)
+    try:
+        rtpd_client.start()
+        while not rtpd_client.stopped():
+            time.sleep(1)
+        rtpd_client.stop()
+    except Exception as ex:
+        print(ex)
+        rtpd_client.stop()
+        return 1
+    return 1 if rtpd_client.failed() else 0
@@ -0,0 +1,137 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from threading import Thread
+import logging
+import time
+
+from utils.watchdog import Heartbeats
+from detection_process import RTPDProcess
+log = logging.getLogger(__name__)
+
+
+class Supervisor:
+    """Watches heartbeats of the detection process and of the network thread. A detection
+    process that failed, exited, did not initialize within init_deadline seconds or missed
+    a stage deadline is restarted, waiting
+    twice as long before each consecutive restart. After max_restarts consecutive restarts,
+    or when the network thread stalls, the supervisor gives up, so the client stops and
+    can be restarted by the service manager. States are reported with the report callback."""
+
+    def __init__(self, rtpd_process: RTPDProcess, heartbeats: Heartbeats, process_lock, report,
+                 deadlines=None, max_restarts=5, max_backoff=60, healthy_after=120, init_deadline=90):
+        self._process = rtpd_process
+        self._heartbeats = heartbeats
+        self._process_lock = process_lock
+        self._report = report
+        # Seconds a stage may go without a heartbeat
+        self._deadlines = {"capture": 15, "inference": 10, "network": 30}
+        self._deadlines.update(deadlines or {})
+        # Seconds the detection process may take to initialize the camera and the detector
+        self._init_deadline = init_deadline
+        self._max_restarts = max_restarts
+        self._max_backoff = max_backoff
+        self._healthy_after = healthy_after
+        self._restarts = 0
+        self._consecutive_restarts = 0
+        self._last_restart = 0.0
+        self._state = None
+        self._gave_up = False
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._thread = Thread(target=self._supervisor_thread_target)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+
+    def gave_up(self):
+        return self._gave_up
+
+    def _set_state(self, state):
+        if (state != self._state):
+            self._state = state
+            self._report({"supervisorState": state, "detectionRestarts": self._restarts})
+
+    def _stalled_stage(self):
+        # frames may legitimately come slower than the capture deadline
+        deadlines = dict(self._deadlines)
+        deadlines["capture"] = max(deadlines["capture"], 3 / self._process.parameters()["framerate"])
+        for stage in ("capture", "inference"):
+            age = self._heartbeats.age(stage)
+            if (age is not None and age > deadlines[stage]):
+                return stage
+        return None
+
+    def _detection_problem(self):
+        if (self._process.failed()):
+            return "failed"
+        if (not self._process.enabled()):
+            return None
+        if (not self._process.alive()):
+            return "exited with code %s" % self._process.exitcode()
+        starting_for = self._process.starting_for()
+        if (starting_for is not None and starting_for > self._init_deadline):
+            return "initialization stalled"
+        if (self._process.started()):
+            stage = self._stalled_stage()
+            if (stage is not None):
+                return "%s stalled" % stage
+        return None
+
+    def _restart(self, problem):
+        backoff = min(2 ** self._consecutive_restarts, self._max_backoff)
+        if (time.monotonic() - self._last_restart < backoff):
+            return
+        if (self._consecutive_restarts >= self._max_restarts):
+            log.error("Supervisor: detection %s after %d restarts, giving up", problem, self._consecutive_restarts)
+            self._set_state("failed")
+            self._gave_up = True
+            return
+        log.error("Supervisor: detection %s, restarting", problem)
+        self._restarts += 1
+        self._consecutive_restarts += 1
+        self._last_restart = time.monotonic()
+        self._set_state("restarting")
+        with self._process_lock:
+            self._process.restart_detection()
+
+    def _check(self):
+        network_age = self._heartbeats.age("network")
+        if (network_age is not None and network_age > self._deadlines["network"]):
+            log.error("Supervisor: network thread stalled for %.0f s, giving up", network_age)
+            self._set_state("network stalled")
+            self._gave_up = True
+            return
+        problem = self._detection_problem()
+        if (problem is not None):
+            self._restart(problem)
+            return
+        if (self._consecutive_restarts and time.monotonic() - self._last_restart > self._healthy_after):
+            self._consecutive_restarts = 0
+        if (not self._process.enabled() or self._process.started()):
+            self._set_state("ok")
+
+    def _supervisor_thread_target(self):
+        while (self._running and not self._gave_up):
+            try:
+                self._check()
+            except Exception as exc:
+                log.error(exc, exc_info=True)
+            time.sleep(1)
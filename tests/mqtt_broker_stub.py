@@ -0,0 +1,143 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from json import dumps, loads
+from threading import Lock, Thread
+import socket
+import struct
+
+PROVISION_REQUEST_TOPIC = "/provision/request"
+PROVISION_RESPONSE_TOPIC = "/provision/response"
+
+
+def _read_exactly(connection, size):
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return data
+
+
+def _read_packet(connection):
+    header = _read_exactly(connection, 1)[0]
+    length, multiplier = 0, 1
+    while True:
+        byte = _read_exactly(connection, 1)[0]
+        length += (byte & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            break
+    return header, _read_exactly(connection, length)
+
+
+def _packet(header, body):
+    length = len(body)
+    encoded = b""
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded += bytes([byte | 0x80 if length else byte])
+        if not length:
+            break
+    return bytes([header]) + encoded + body
+
+
+def _string(text):
+    data = text.encode()
+    return struct.pack("!H", len(data)) + data
+
+
+class ProvisionBrokerStub:
+    """Minimal MQTT 3.1.1 broker that answers ThingsBoard provisioning requests over plain
+    TCP. Devices are provisioned with token "token-<device name>" when the provisioning key
+    matches. disconnect_on lists request numbers (from 1) that are answered by closing
+    the connection instead, like a server-side disconnect."""
+
+    def __init__(self, provision_device_key="key", disconnect_on=()):
+        self.provision_device_key = provision_device_key
+        self.disconnect_on = set(disconnect_on)
+        self.requests = []
+        self.connections = 0
+        self._lock = Lock()
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", 0))
+        self.port = self._server.getsockname()[1]
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._server.listen(16)
+        Thread(target=self._accept, daemon=True).start()
+
+    def stop(self):
+        self._running = False
+        self._server.close()
+
+    def _accept(self):
+        while self._running:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connections += 1
+            Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _serve(self, connection):
+        try:
+            while True:
+                header, body = _read_packet(connection)
+                packet_type = header >> 4
+                if packet_type == 1:  # CONNECT
+                    connection.sendall(_packet(0x20, b"\x00\x00"))
+                elif packet_type == 8:  # SUBSCRIBE
+                    topics = 0
+                    position = 2
+                    while position < len(body):
+                        position += 2 + struct.unpack("!H", body[position:position + 2])[0] + 1
+                        topics += 1
+                    connection.sendall(_packet(0x90, body[:2] + b"\x00" * topics))
+                elif packet_type == 3:  # PUBLISH
+                    topic_length = struct.unpack("!H", body[:2])[0]
+                    topic = body[2:2 + topic_length].decode()
+                    payload = body[2 + topic_length + (2 if header & 0x06 else 0):]
+                    if topic == PROVISION_REQUEST_TOPIC and not self._answer(connection, loads(payload)):
+                        return
+                elif packet_type == 12:  # PINGREQ
+                    connection.sendall(_packet(0xD0, b""))
+                elif packet_type == 14:  # DISCONNECT
+                    return
+        except (ConnectionError, OSError):
+            return
+        finally:
+            connection.close()
+
+    def _answer(self, connection, request):
+        """Returns False when the connection is closed instead of answering"""
+        with self._lock:
+            self.requests.append(request)
+            number = len(self.requests)
+        if number in self.disconnect_on:
+            return False
+        if request.get("provisionDeviceKey") == self.provision_device_key:
+            response = {"status": "SUCCESS", "credentialsType": "ACCESS_TOKEN",
+                        "credentialsValue": "token-%s" % request.get("deviceName")}
+        else:
+            response = {"status": "FAILURE", "errorMsg": "Provision data was not found!"}
+        connection.sendall(_packet(0x30, _string(PROVISION_RESPONSE_TOPIC) + dumps(response).encode()))
+        return True
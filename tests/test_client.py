@@ -0,0 +1,31 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from json import dump
+
+import rtpd_client
+
+
+def test_cached_configuration_is_sent_after_the_connect(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open("credentials.json", "w") as credentials_file:
+        dump({"default": "token"}, credentials_file)
+    with open("config.json", "w") as config_file:
+        dump({"values": {"detectionEnabled": True, "detectionBounds": {}, "countingLine": {}},
+              "versions": {}}, config_file)
+    client = rtpd_client.RTPDClient(("127.0.0.1", 1883), str(tmp_path / "credentials.json"))
+    assert client._configured
+    assert client._client.pending_publishes() == 0
+    assert client._publisher._last_status == {"configured": True}
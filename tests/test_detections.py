@@ -0,0 +1,34 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+import numpy as np
+
+from utils.detections import detection_arrays, foot_points
+
+
+def test_detection_arrays_clip_boxes_and_scale_confidences():
+    boxes, confidences = detection_arrays([
+        {"bbox": (0.2, 0.1, 0.4, 0.9), "confidence": 0.75},
+        {"bbox": (0.9, -0.01, 1.003, 1.02), "confidence": 0.4},
+    ])
+    np.testing.assert_allclose(boxes, [[0.2, 0.1, 0.4, 0.9], [0.9, 0, 1, 1]])
+    np.testing.assert_allclose(confidences, [75, 40])
+    np.testing.assert_allclose(foot_points(boxes), [[0.3, 0.9], [0.95, 1]])
+
+
+def test_detection_arrays_without_detections():
+    boxes, confidences = detection_arrays([])
+    assert boxes.shape == (0, 4) and confidences.shape == (0,)
+    assert foot_points(boxes).shape == (0, 2)
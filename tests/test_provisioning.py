@@ -0,0 +1,96 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from types import SimpleNamespace
+import socket
+
+import pytest
+
+from provision_fleet import FleetProvisioner
+from utils.credentials import CredentialsStore
+from utils.tb_device_mqtt import ProvisionClient, TBDeviceMqttClient, TBTimeoutException
+
+
+def _request(device_name, key="key"):
+    return TBDeviceMqttClient.provision_request(key, "secret", device_name)
+
+
+def _closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_provision_client_reuses_connection(broker):
+    client = ProvisionClient("127.0.0.1", broker.port)
+    client.open(timeout=5)
+    try:
+        for device_name in ("pi-1", "pi-2", "pi-3"):
+            assert client.request(_request(device_name), timeout=5) == "token-" + device_name
+    finally:
+        client.close()
+    assert broker.connections == 1
+    assert not client.is_connected()
+
+
+def test_provision_client_rejected(broker):
+    client = ProvisionClient("127.0.0.1", broker.port)
+    client.open(timeout=5)
+    try:
+        assert client.request(_request("pi-1", key="wrong"), timeout=5) == ""
+    finally:
+        client.close()
+
+
+def test_provision_client_times_out_after_server_disconnect(broker):
+    broker.disconnect_on = {1}
+    client = ProvisionClient("127.0.0.1", broker.port)
+    client.open(timeout=5)
+    try:
+        with pytest.raises(TBTimeoutException):
+            client.request(_request("pi-1"), timeout=1)
+    finally:
+        client.close()
+
+
+def test_fleet_provisioner_retries_after_server_disconnect(broker, tmp_path):
+    broker.disconnect_on = {2}
+    store = CredentialsStore(str(tmp_path / "credentials.json"), legacy_filename=None)
+    provisioner = FleetProvisioner("127.0.0.1", broker.port, "key", "secret", store,
+                                   timeout=1, retries=3, retry_delay=0)
+    device_names = ["pi-%d" % i for i in range(4)]
+    assert provisioner.provision_all(device_names, pool_size=1) == []
+    assert all(store.get(name) == "token-" + name for name in device_names)
+    # the second request was lost with the connection and sent again over a new one
+    assert len(broker.requests) == 5
+    assert broker.connections >= 2
+    assert not any(client.is_connected() for client in provisioner._opened)
+
+
+def test_fleet_provisioner_skips_provisioned_devices(broker, tmp_path):
+    store = CredentialsStore(str(tmp_path / "credentials.json"), legacy_filename=None)
+    store.set("pi-1", "existing")
+    provisioner = FleetProvisioner("127.0.0.1", broker.port, "key", "secret", store, timeout=1)
+    assert provisioner.provision_all(["pi-1", "pi-2"], pool_size=2) == []
+    assert store.get("pi-1") == "existing"
+    assert [request["deviceName"] for request in broker.requests] == ["pi-2"]
+
+
+def test_obtain_token_survives_refused_connection(tmp_path, monkeypatch):
+    import rtpd_client
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(rtpd_client, "use_tls", False)
+    client = SimpleNamespace(_server=("127.0.0.1", _closed_port()))
+    assert rtpd_client.RTPDClient._obtain_token(client, str(tmp_path / "credentials.json")) == ""
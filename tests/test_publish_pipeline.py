@@ -0,0 +1,128 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from types import SimpleNamespace
+
+import pytest
+
+from utils import publish_pipeline
+from utils.publish_pipeline import PublishPipeline
+from utils.records import DetectionRecord
+from utils.tb_device_mqtt import TBDeviceMqttClient, TBPublishInfo
+from utils.timing import WallClock
+
+
+def _pipeline(queue_capacity=10):
+    client = TBDeviceMqttClient("127.0.0.1", "token", validate_payloads=False)
+    return client, PublishPipeline(client, queue_capacity, WallClock())
+
+
+def test_status_while_disconnected_is_kept_for_the_connect():
+    client, pipeline = _pipeline()
+    info = pipeline.send_status({"detecting": True})
+    assert info.rc() == TBPublishInfo.TB_ERR_NO_CONN
+    assert client.pending_publishes() == 1
+    assert not pipeline.ready()
+    # values paho could not send are not deduplicated
+    assert pipeline.send_status({"detecting": True}).rc() == TBPublishInfo.TB_ERR_NO_CONN
+
+
+class _Client:
+    """Connected MQTT client that accepts every message"""
+
+    def __init__(self):
+        self.attributes = []
+        self.telemetry = []
+        self.pending = 0
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+    def max_queued_messages_set(self, queue_size):
+        pass
+
+    def is_connected(self):
+        return True
+
+    def pending_publishes(self):
+        return self.pending
+
+    def send_attributes(self, attributes, quality_of_service=None):
+        self.attributes.append(attributes)
+        return TBPublishInfo(SimpleNamespace(rc=TBPublishInfo.TB_ERR_SUCCESS))
+
+    def send_telemetry(self, telemetry, quality_of_service=None):
+        self.telemetry.append(telemetry)
+        return TBPublishInfo(SimpleNamespace(rc=TBPublishInfo.TB_ERR_SUCCESS))
+
+
+@pytest.fixture
+def now(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(publish_pipeline, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_status_is_deduplicated_and_resent_after_a_reconnect(now):
+    client = _Client()
+    pipeline = PublishPipeline(client, 10, WallClock())
+    pipeline.send_status({"detecting": True, "configured": True})
+    assert pipeline.send_status({"detecting": True}) is None
+    pipeline.send_status({"detecting": False})
+    assert client.attributes == [{"detecting": True, "configured": True}, {"detecting": False}]
+    pipeline.connection_lost()
+    pipeline.connected()
+    assert client.attributes[-1] == {"detecting": False, "configured": True}
+
+
+def test_detection_interval_steps_with_the_backlog(now):
+    pipeline = PublishPipeline(_Client(), 10, WallClock(), max_detection_interval=4.0)
+    intervals = []
+    for depth in (8, 8, 8, 8, 5, 2, 2, 2, 2):
+        now[0] += 10
+        intervals.append(pipeline.detection_interval(depth))
+    assert intervals == [1.0, 2.0, 4.0, 4.0, 4.0, 2.0, 1.0, 0.0, 0.0]
+    # no second step within the current interval
+    pipeline.detection_interval(8)
+    now[0] += 0.5
+    assert pipeline.detection_interval(8) == 1.0
+
+
+def test_window_and_clock_hold_publishing(now):
+    client = _Client()
+    clock = SimpleNamespace(synchronized=lambda: False, to_wall_ms=lambda mono: int(mono * 1000))
+    pipeline = PublishPipeline(client, 10, clock, inflight_window=2, max_unsynchronized_hold=60.0)
+    assert not pipeline.ready()
+    now[0] += 61
+    assert pipeline.ready()
+    client.pending = 2
+    assert not pipeline.ready()
+
+
+def test_journaled_telemetry_is_resent_after_a_disconnect(now):
+    client = _Client()
+    clock = SimpleNamespace(synchronized=lambda: True, to_wall_ms=lambda mono: int(mono * 1000))
+    pipeline = PublishPipeline(client, 10, clock, journal_window=60.0)
+    pipeline.publish(DetectionRecord(now[0], {"numberOfPeople": 1}), 0, 0)
+    now[0] += 100
+    pipeline.publish(DetectionRecord(now[0], {"numberOfPeople": 2}), 0, 0)
+    now[0] += 10
+    pipeline.resend_journal()
+    assert len(client.telemetry) == 2
+    pipeline.connection_lost()
+    pipeline.resend_journal()
+    assert [record["values"]["numberOfPeople"] for record in client.telemetry[-1]] == [2]
+    pipeline.resend_journal()
+    assert len(client.telemetry) == 3
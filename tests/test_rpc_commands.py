@@ -0,0 +1,58 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from json import loads
+from types import SimpleNamespace
+
+from rpc_commands import RPCCommands
+
+
+class _Client:
+    def __init__(self):
+        self.replies = {}
+        self.telemetry = []
+
+    def send_rpc_reply(self, request_id, response):
+        self.replies[request_id] = loads(response)
+
+    def send_telemetry(self, telemetry, quality_of_service=None):
+        self.telemetry.append(telemetry)
+
+
+def _commands(results=()):
+    results = list(results)
+    process = SimpleNamespace(request_profile=lambda seconds: True,
+                              command_result=lambda: results.pop(0) if results else None)
+    client = _Client()
+    return client, RPCCommands(client, process, dict, None)
+
+
+def test_invalid_params_get_an_error_reply():
+    client, commands = _commands()
+    commands.handle_request(None, "1", {"method": "setDetectionParameters", "params": "framerate"})
+    commands.handle_request(None, "2", {"method": "profile", "params": [1]})
+    commands.handle_request(None, "3", ["profile"])
+    assert client.replies["1"] == {"error": "params must be an object"}
+    assert client.replies["2"] == {"error": "params must be an object"}
+    assert "error" in client.replies["3"]
+
+
+def test_profile_is_acknowledged_and_sent_as_telemetry():
+    summary = {"iterations": 3, "stats": "eJw="}
+    client, commands = _commands([("profile", summary)])
+    commands.handle_request(None, "1", {"method": "profile", "params": {"seconds": 10}})
+    assert client.replies["1"] == {"target": "detection", "seconds": 10, "started": True}
+    commands.poll()
+    assert client.telemetry == [{"profileTarget": "detection", "profileIterations": 3, "profileStats": "eJw="}]
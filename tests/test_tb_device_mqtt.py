@@ -0,0 +1,93 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from json import dumps
+from types import SimpleNamespace
+
+import pytest
+
+from utils.tb_device_mqtt import (ATTRIBUTES_TOPIC, ATTRIBUTES_TOPIC_REQUEST, ATTRIBUTES_TOPIC_RESPONSE,
+                                  TBDeviceMqttClient)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = TBDeviceMqttClient("127.0.0.1", "token")
+    client.requests = []
+    publish = client._client.publish
+
+    def recording_publish(topic, payload=None, qos=0):
+        client.requests.append(topic)
+        return publish(topic, payload, qos)
+    monkeypatch.setattr(client._client, "publish", recording_publish)
+    yield client
+    client.stop()
+
+
+def _receive(client, topic, content):
+    client._on_message(None, None, SimpleNamespace(topic=topic, payload=dumps(content).encode()))
+
+
+def _collector():
+    results = []
+    return results, lambda _client, result, exception: results.append((result, exception))
+
+
+def test_concurrent_requests_share_one_request(client):
+    first, first_callback = _collector()
+    second, second_callback = _collector()
+    client.request_attributes(shared_keys=["a", "b"], callback=first_callback)
+    client.request_attributes(shared_keys=["b", "a"], callback=second_callback)
+    assert len(client.requests) == 1
+    _receive(client, ATTRIBUTES_TOPIC_RESPONSE + "1", {"shared": {"a": 1, "b": [2]}})
+    assert first == second == [({"shared": {"a": 1, "b": [2]}}, None)]
+    # every callback gets its own copy
+    first[0][0]["shared"]["b"].append(3)
+    assert second[0][0]["shared"]["b"] == [2]
+
+
+def test_different_keys_are_requested_separately(client):
+    client.request_attributes(shared_keys=["a"])
+    client.request_attributes(shared_keys=["a"], client_keys=["c"])
+    assert len(client.requests) == 2
+
+
+def test_cached_response_is_used_until_a_key_is_updated(client):
+    client.request_attributes(shared_keys=["a"])
+    _receive(client, ATTRIBUTES_TOPIC_RESPONSE + "1", {"shared": {"a": 1}})
+    cached, callback = _collector()
+    assert client.request_attributes(shared_keys=["a"], callback=callback) is None
+    assert cached == [({"shared": {"a": 1}}, None)] and len(client.requests) == 1
+    client.request_attributes(shared_keys=["a"], use_cache=False)
+    assert len(client.requests) == 2
+    _receive(client, ATTRIBUTES_TOPIC_RESPONSE + "2", {"shared": {"a": 1}})
+    _receive(client, ATTRIBUTES_TOPIC, {"b": 2})
+    client.request_attributes(shared_keys=["a"])
+    assert len(client.requests) == 2
+    _receive(client, ATTRIBUTES_TOPIC, {"a": 2})
+    client.request_attributes(shared_keys=["a"])
+    assert len(client.requests) == 3
+
+
+def test_client_attribute_changes_and_disconnects_clear_the_cache(client):
+    client.request_attributes(client_keys=["c"])
+    _receive(client, ATTRIBUTES_TOPIC_RESPONSE + "1", {"client": {"c": 1}})
+    client.send_attributes({"c": 2})
+    client.request_attributes(client_keys=["c"])
+    assert client.requests[-1] == ATTRIBUTES_TOPIC_REQUEST + "2"
+    _receive(client, ATTRIBUTES_TOPIC_RESPONSE + "2", {"client": {"c": 2}})
+    client._on_disconnect(None, None, 1)
+    client.request_attributes(client_keys=["c"])
+    assert client.requests[-1] == ATTRIBUTES_TOPIC_REQUEST + "3"
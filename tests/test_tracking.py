@@ -0,0 +1,62 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+import numpy as np
+
+from utils.tracking import Tracker
+
+
+def _points(*points):
+    return np.array(points, dtype=np.float32).reshape(-1, 2)
+
+
+def _tracker():
+    tracker = Tracker()
+    tracker.set_line([[0.5, 0], [0.5, 1]])
+    return tracker
+
+
+def test_crossing_at_one_frame_per_second_is_counted():
+    tracker = _tracker()
+    tracker.update(_points([0.7, 0.5]), 0.0)
+    tracker.update(_points([0.3, 0.5]), 1.0)
+    values = tracker.collect()
+    assert (values["entriesTotal"], values["exitsTotal"]) == (1, 0)
+    tracker.update(_points([0.7, 0.5]), 2.0)
+    assert tracker.collect()["exitsTotal"] == 1
+
+
+def test_long_detection_interval_does_not_pair_detections():
+    tracker = _tracker()
+    tracker.update(_points([0.7, 0.5]), 0.0)
+    tracker.update(_points([0.4, 0.5]), 32.0)
+    values = tracker.collect()
+    assert (values["entriesTotal"], values["exitsTotal"]) == (0, 0)
+    assert values["dwellTimeCount"] == 1
+    assert values["trackedPeople"] == 1
+
+
+def test_match_reach_is_capped():
+    tracker = _tracker()
+    tracker.update(_points([0.9, 0.5]), 0.0)
+    tracker.update(_points([0.2, 0.5]), 3.0)
+    assert tracker.collect()["entriesTotal"] == 0
+
+
+def test_totals_continue_from_given_values():
+    tracker = Tracker(entries=5, exits=2)
+    tracker.update(_points(), 0.0)
+    values = tracker.collect()
+    assert (values["entriesTotal"], values["exitsTotal"], values["trackedPeople"]) == (5, 2, 0)
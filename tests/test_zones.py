@@ -0,0 +1,52 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+import numpy as np
+
+from utils.zone_config import DEFAULT_ZONE, parse_detection_bounds
+from utils.zones import ZoneIndex, people_values
+
+SQUARE = [{"x": 0.1, "y": 0.1}, {"x": 0.5, "y": 0.1}, {"x": 0.5, "y": 0.5}, {"x": 0.1, "y": 0.5}]
+TRIANGLE = [{"x": 0.4, "y": 0.4}, {"x": 0.9, "y": 0.4}, {"x": 0.9, "y": 0.9}]
+
+
+def _points(*points):
+    return np.array(points, dtype=np.float32).reshape(-1, 2)
+
+
+def test_parse_detection_bounds():
+    assert parse_detection_bounds(SQUARE) == {DEFAULT_ZONE: [[0.1, 0.1], [0.5, 0.1], [0.5, 0.5], [0.1, 0.5]]}
+    assert list(parse_detection_bounds({"door": SQUARE, "desk": TRIANGLE})) == ["door", "desk"]
+    assert parse_detection_bounds({}) == {}
+    assert parse_detection_bounds(SQUARE[:2]) is None
+    assert parse_detection_bounds({"door": [{"x": 2, "y": 0}] * 3}) is None
+    assert parse_detection_bounds({"": SQUARE}) is None
+    assert parse_detection_bounds("door") is None
+
+
+def test_zone_membership_of_overlapping_zones():
+    index = ZoneIndex(parse_detection_bounds({"door": SQUARE, "desk": TRIANGLE}))
+    membership = index.membership(_points([0.2, 0.2], [0.45, 0.45], [0.8, 0.6], [0.5, 0.8], [0.95, 0.95]))
+    assert membership.tolist() == [[True, False], [True, True], [False, True], [False, False], [False, False]]
+
+
+def test_people_values():
+    points = _points([0.2, 0.2], [0.45, 0.45], [0.95, 0.95])
+    index = ZoneIndex(parse_detection_bounds({"door": SQUARE, "desk": TRIANGLE}))
+    assert people_values(index, points) == {"numberOfPeople": 2, "numberOfPeople_door": 2,
+                                            "numberOfPeople_desk": 1}
+    assert people_values(ZoneIndex({}), points) == {"numberOfPeople": 3}
+    assert people_values(index, _points()) == {"numberOfPeople": 0, "numberOfPeople_door": 0,
+                                               "numberOfPeople_desk": 0}
@@ -0,0 +1,67 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from json import load
+import logging
+import time
+from utils.files import write_json_atomic
+log = logging.getLogger(__name__)
+
+
+class ConfigCache:
+    """Shared attribute values received from ThingsBoard, persisted to a file so the
+    device keeps its configuration across reconnects and restarts. Every key carries
+    the time it last changed, which serves as its version."""
+
+    def __init__(self, filename='config.json'):
+        self._filename = filename
+        self._values = {}
+        self._versions = {}
+        try:
+            with open(filename) as cache_file:
+                cached = load(cache_file)
+            self._values = cached["values"]
+            self._versions = cached["versions"]
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def values(self):
+        return dict(self._values)
+
+    def version(self, key):
+        return self._versions.get(key, 0)
+
+    def update(self, attributes, keys=None):
+        """Stores attribute values and returns the keys whose value changed. If keys are
+        given, attributes is a full snapshot of them and missing keys are removed"""
+        changed = [key for key, value in attributes.items()
+                   if key not in self._values or self._values[key] != value]
+        removed = [key for key in (keys or []) if key in self._values and key not in attributes]
+        if (changed or removed):
+            now = int(time.time() * 1000)
+            for key in changed:
+                self._values[key] = attributes[key]
+                self._versions[key] = now
+            for key in removed:
+                del self._values[key]
+                self._versions[key] = now
+            self._save()
+        return changed + removed
+
+    def _save(self):
+        try:
+            write_json_atomic(self._filename, {"values": self._values, "versions": self._versions})
+        except IOError as err:
+            log.warning("Client: unable to save configuration cache: %s", err)
@@ -0,0 +1,58 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from json import load
+from threading import Lock
+from typing import Dict, Optional
+from utils.files import write_json_atomic
+
+DEFAULT_DEVICE = 'default'
+
+
+class CredentialsStore:
+    """Device access tokens keyed by device name, stored in a JSON file. The file is
+    rewritten atomically on every change. A legacy credentials file holding a single
+    token is used for devices missing from the store."""
+
+    def __init__(self, filename='credentials.json', legacy_filename='credentials.txt'):
+        self._filename = filename
+        self._legacy_filename = legacy_filename
+        self._lock = Lock()
+        try:
+            with open(filename) as credentials_file:
+                self._tokens: Dict[str, str] = load(credentials_file)
+        except (IOError, ValueError):
+            self._tokens = {}
+
+    def get(self, device_name: Optional[str] = None) -> str:
+        """Token of the device, or an empty string if it is not known"""
+        with self._lock:
+            token = self._tokens.get(device_name or DEFAULT_DEVICE)
+        if (token or not self._legacy_filename):
+            return token or ''
+        try:
+            with open(self._legacy_filename) as token_file:
+                return token_file.readline().strip()
+        except IOError:
+            return ''
+
+    def set(self, device_name: Optional[str], token: str):
+        with self._lock:
+            self._tokens[device_name or DEFAULT_DEVICE] = token
+            write_json_atomic(self._filename, self._tokens)
+
+    def devices(self):
+        with self._lock:
+            return list(self._tokens.keys())
@@ -0,0 +1,44 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from collections import deque
+from threading import Lock
+from typing import Optional
+
+
+class CachedDetections:
+    __slots__ = ('ts', 'boxes', 'confidences')
+
+    def __init__(self, ts, boxes, confidences):
+        self.ts = ts
+        self.boxes = boxes
+        self.confidences = confidences
+
+
+class DetectionRing:
+    """Raw detections (boxes and confidences) of the last frames. Shared by the detection
+    loop and the recount thread."""
+
+    def __init__(self, capacity=30):
+        self._entries = deque(maxlen=capacity)
+        self._lock = Lock()
+
+    def add(self, ts, boxes, confidences):
+        with self._lock:
+            self._entries.append(CachedDetections(ts, boxes, confidences))
+
+    def latest(self) -> Optional[CachedDetections]:
+        with self._lock:
+            return self._entries[-1] if self._entries else None
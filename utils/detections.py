@@ -0,0 +1,43 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from typing import Tuple
+import numpy as np
+
+# Output of Detector.detect_from_image: one dictionary per person with the box of the
+# model output layer as (xmin, ymin, xmax, ymax) normalized to the frame size, and the
+# confidence as a fraction. SSD boxes of people at the frame border may overshoot it.
+BOX_KEY = 'bbox'
+CONFIDENCE_KEY = 'confidence'
+CONFIDENCE_SCALE = 100  # fraction to percent, the unit of detection thresholds
+
+
+def detection_arrays(detection_data) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert detector output into compact arrays. Returns an (N, 4) float32 array of
+    (xmin, ymin, xmax, ymax) boxes clipped to the frame and an (N,) float32 array of
+    confidences in percent."""
+    boxes = np.zeros((len(detection_data), 4), dtype=np.float32)
+    confidences = np.zeros(len(detection_data), dtype=np.float32)
+    for i, person in enumerate(detection_data):
+        boxes[i] = person[BOX_KEY]
+        confidences[i] = person[CONFIDENCE_KEY]
+    np.clip(boxes, 0, 1, out=boxes)
+    confidences *= CONFIDENCE_SCALE
+    return boxes, confidences
+
+
+def foot_points(boxes: np.ndarray) -> np.ndarray:
+    """Bottom-center point of every box, the point that touches the floor"""
+    return np.stack(((boxes[:, 0] + boxes[:, 2]) / 2, boxes[:, 3]), axis=1)
@@ -0,0 +1,33 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from json import dump
+import os
+import tempfile
+
+
+def write_json_atomic(filename, data):
+    """Writes data as JSON into a temporary file next to filename and renames it over
+    filename, so readers never see a partially written file"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as json_file:
+        try:
+            dump(data, json_file)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        except BaseException:
+            os.unlink(json_file.name)
+            raise
+    os.replace(json_file.name, filename)
@@ -0,0 +1,147 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import util
+from threading import Lock
+import logging
+import queue
+import time
+import sys
+import os
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Listener of this process and the settings it was started with
+_listener = None
+_listener_pid = None
+_settings = None
+
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most burst records with the same logger, level and message template per
+    interval seconds. The first record passed after others were dropped carries their count."""
+
+    def __init__(self, interval=60.0, burst=5, max_templates=500):
+        super().__init__()
+        self._interval = interval
+        self._burst = burst
+        self._max_templates = max_templates
+        # Message template to [window start, records passed, records dropped]
+        self._windows = {}
+        self._lock = Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg if isinstance(record.msg, str) else str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self._interval:
+                if window is None and len(self._windows) >= self._max_templates:
+                    self._windows = {k: w for k, w in self._windows.items() if now - w[0] < self._interval}
+                record.suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+                return True
+            if window[1] < self._burst:
+                window[1] += 1
+                record.suppressed = 0
+                return True
+            window[2] += 1
+            return False
+
+
+class _Formatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        if getattr(record, "suppressed", 0):
+            text += " (%d similar messages suppressed)" % record.suppressed
+        return text
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the listener thread without formatting them. Records are dropped
+    when the queue is full, logging never blocks the caller"""
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def parse_levels(text):
+    """Reads per-module levels given as "module=LEVEL,module=LEVEL" """
+    levels = {}
+    for item in (text or "").split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(level="INFO", levels=None, capacity=1000, interval=60.0, burst=5):
+    """Sends log records through a bounded queue to a listener thread writing to stderr,
+    so logging calls only do a level check, a rate limit check and a queue put.
+    levels sets the level of single loggers, e.g. {"utils.tb_device_mqtt": "WARNING"}"""
+    global _listener, _listener_pid, _settings
+    _stop_listener()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.setLevel(level.upper())
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    records = queue.Queue(capacity)
+    handler = _NonBlockingQueueHandler(records)
+    handler.addFilter(RateLimitFilter(interval, burst))
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(_Formatter(FORMAT))
+    _listener = _Listener(records, output)
+    _listener.start()
+    _listener_pid = os.getpid()
+    _settings = (level, levels, capacity, interval, burst)
+    root.addHandler(handler)
+    # also stops the listener when a multiprocessing child process exits
+    util.Finalize(None, _stop_listener, exitpriority=0)
+
+
+def logging_settings():
+    """Arguments of the last setup_logging call, None if logging was not set up"""
+    return _settings
+
+
+def init_process_logging(settings=None):
+    """Starts logging in a child process. A forked process inherits the queue handler but not
+    the listener thread, a spawned process gets the settings of its parent. Does nothing in
+    the process that set up logging"""
+    settings = settings or _settings
+    if settings is not None and _listener_pid != os.getpid():
+        setup_logging(*settings)
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,65 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from typing import Optional
+import base64
+import io
+import time
+import zlib
+
+
+def compress_text(text: str) -> str:
+    """zlib compressed, base64 encoded text that fits into a telemetry value"""
+    return base64.b64encode(zlib.compress(text.encode(), 9)).decode()
+
+
+class LoopProfiler:
+    """Profiles iterations of a loop with cProfile for a limited time. Iterations are
+    wrapped in enable() and disable(), which do nothing while no capture is running."""
+
+    def __init__(self):
+        # cProfile and pstats are imported with the first capture
+        self._profile = None
+        self._deadline = 0.0
+        self._iterations = 0
+
+    def start(self, seconds):
+        import cProfile
+        self._profile = cProfile.Profile()
+        self._deadline = time.monotonic() + seconds
+        self._iterations = 0
+
+    def active(self):
+        return self._profile is not None
+
+    def enable(self):
+        if self._profile is not None:
+            self._profile.enable()
+
+    def disable(self):
+        if self._profile is not None:
+            self._profile.disable()
+            self._iterations += 1
+
+    def collect(self, limit=30) -> Optional[dict]:
+        """Returns the capture summary once its time is up, otherwise None"""
+        if self._profile is None or time.monotonic() < self._deadline:
+            return None
+        import pstats
+        text = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=text)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+        self._profile = None
+        return {"iterations": self._iterations, "stats": compress_text(text.getvalue())}
@@ -0,0 +1,182 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from collections import deque
+from threading import Lock
+import logging
+import time
+from utils.tb_device_mqtt import TBDeviceMqttClient, TBPublishInfo
+from utils.records import DetectionRecord
+from utils.timing import WallClock
+log = logging.getLogger(__name__)
+
+
+class DeliveryPolicy:
+    """How a class of messages is delivered. QoS0 messages can be journaled: they are kept
+    for journal_window seconds after sending and sent again after an unexpected disconnect,
+    since the broker may never have received them. ThingsBoard stores telemetry by key and
+    timestamp, so a record received twice is stored once. Deduplicated messages are only
+    sent for attribute values that differ from the last value sent."""
+
+    def __init__(self, qos, journal=False, deduplicate=False):
+        self.qos = qos
+        self.journal = journal
+        self.deduplicate = deduplicate
+
+
+TELEMETRY_POLICY = DeliveryPolicy(qos=0, journal=True)
+STATUS_POLICY = DeliveryPolicy(qos=1, deduplicate=True)
+HEARTBEAT_POLICY = DeliveryPolicy(qos=0)
+
+
+class PublishPipeline:
+    """Publishes detection results with explicit backpressure. At most inflight_window
+    messages are pending at once (waiting for a PUBACK, or for QoS0 to be written to the
+    socket) and paho keeps at most queued_limit QoS>0 messages, so results stay in the
+    bounded detection queue while the broker cannot take them. When the detection queue
+    fills up, the detection interval is doubled until the backlog drains. Methods are
+    called from the network thread and from MQTT callbacks."""
+
+    def __init__(self, client: TBDeviceMqttClient, queue_capacity, clock: WallClock, inflight_window=10,
+                 queued_limit=20, max_detection_interval=32.0, telemetry_policy=TELEMETRY_POLICY,
+                 status_policy=STATUS_POLICY, heartbeat_policy=HEARTBEAT_POLICY, journal_window=60.0,
+                 max_journal_records=120, max_unsynchronized_hold=60.0):
+        self._client = client
+        # Records are held while the wall clock is not synchronized, at most for
+        # max_unsynchronized_hold seconds after start, so that they get correct timestamps
+        self._clock = clock
+        self._hold_until = time.monotonic() + max_unsynchronized_hold
+        self._telemetry_policy = telemetry_policy
+        self._status_policy = status_policy
+        self._heartbeat_policy = heartbeat_policy
+        # Recently sent QoS0 telemetry as (send time, record), status values the server has
+        # and the last value of every status attribute
+        self._lock = Lock()
+        self._journal = deque(maxlen=max_journal_records)
+        self._journal_window = journal_window
+        self._disconnected_at = None
+        self._status = {}
+        self._last_status = {}
+        self._queue_capacity = queue_capacity
+        self._inflight_window = inflight_window
+        self._max_detection_interval = max_detection_interval
+        self._detection_interval = 0.0
+        self._interval_changed = 0.0
+        self._failed_publishes = 0
+        self._client.max_inflight_messages_set(inflight_window)
+        self._client.max_queued_messages_set(queued_limit)
+
+    def ready(self):
+        """Whether the next message can be handed to the MQTT client"""
+        return (self._client.is_connected() and self._client.pending_publishes() < self._inflight_window and
+                (time.monotonic() > self._hold_until or self._clock.synchronized()))
+
+    def detection_interval(self, queue_depth):
+        """Minimum time between detections (seconds) for the current backlog. Degrades the
+        detection rate when the queue is above 80% of capacity and restores it below 20%.
+        The interval changes at most once per current interval (at least a second), so the
+        backlog can react to every step"""
+        now = time.monotonic()
+        if (now - self._interval_changed < max(self._detection_interval, 1.0)):
+            return self._detection_interval
+        fill = queue_depth / self._queue_capacity
+        previous = self._detection_interval
+        if (fill >= 0.8 and self._detection_interval < self._max_detection_interval):
+            self._detection_interval = min(max(self._detection_interval * 2, 1.0),
+                                           self._max_detection_interval)
+            log.warning("Network: backlog of %d results, detection interval %.0f s",
+                        queue_depth, self._detection_interval)
+        elif (fill <= 0.2 and self._detection_interval > 0):
+            self._detection_interval = self._detection_interval / 2 if self._detection_interval > 1 else 0.0
+        if (self._detection_interval != previous):
+            self._interval_changed = now
+        return self._detection_interval
+
+    def metrics(self, queue_depth, dropped_detections):
+        return {
+            "queueDepth": queue_depth,
+            "droppedDetections": dropped_detections,
+            "pendingPublishes": self._client.pending_publishes(),
+            "failedPublishes": self._failed_publishes,
+        }
+
+    def publish(self, record: DetectionRecord, queue_depth, dropped_detections):
+        """Sends a detection result together with the pipeline state. The monotonic capture
+        time of the result is converted to its wall-clock timestamp"""
+        detection_result = {"ts": self._clock.to_wall_ms(record.mono), "values": record.values}
+        detection_result["values"].update(self.metrics(queue_depth, dropped_detections))
+        info = self._client.send_telemetry(detection_result, self._telemetry_policy.qos)
+        with self._lock:
+            if (info.rc() not in (TBPublishInfo.TB_ERR_SUCCESS, TBPublishInfo.TB_ERR_NO_CONN)):
+                self._failed_publishes += 1
+            if (self._telemetry_policy.journal):
+                self._journal.append((time.monotonic(), detection_result))
+        return info
+
+    def send_status(self, attributes):
+        """Sends status attributes, skipping values the server already has. Values only
+        count as sent when the MQTT client accepted them"""
+        with self._lock:
+            self._last_status.update(attributes)
+            if (self._status_policy.deduplicate):
+                attributes = {key: value for key, value in attributes.items()
+                              if key not in self._status or self._status[key] != value}
+                if (not attributes):
+                    return None
+        info = self._client.send_attributes(attributes, self._status_policy.qos)
+        if (self._status_policy.deduplicate and info.rc() == TBPublishInfo.TB_ERR_SUCCESS):
+            with self._lock:
+                self._status.update(attributes)
+        return info
+
+    def update_status(self, attributes):
+        """Records status values without sending them, connected() sends them"""
+        with self._lock:
+            self._last_status.update(attributes)
+
+    def heartbeat(self):
+        return self._client.send_attributes({}, self._heartbeat_policy.qos)
+
+    def connection_lost(self):
+        """Called when the connection fails. Journaled telemetry is resent by resend_journal()
+        and status by connected()"""
+        with self._lock:
+            if (self._disconnected_at is None):
+                self._disconnected_at = time.monotonic()
+            self._status = {}
+
+    def connected(self):
+        """Called when the connection is established. Sends the last value of every status
+        attribute, the server may have missed changes while the client was disconnected"""
+        with self._lock:
+            self._status = {}
+            status = dict(self._last_status)
+        if (status):
+            self.send_status(status)
+
+    def resend_journal(self):
+        """Sends again the journaled telemetry that may have been lost with the connection"""
+        if (not self._client.is_connected()):
+            return
+        with self._lock:
+            if (self._disconnected_at is None):
+                return
+            since = self._disconnected_at - self._journal_window
+            lost = [record for sent, record in self._journal if sent >= since]
+            self._journal.clear()
+            self._disconnected_at = None
+        if (lost):
+            log.info("Network: resending %d telemetry records sent before the disconnect", len(lost))
+            self._client.send_telemetry(lost, self._telemetry_policy.qos)
@@ -0,0 +1,37 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+class DetectionRecord:
+    """People counts of one frame, stamped with the monotonic capture time"""
+    __slots__ = ('mono', 'values')
+
+    def __init__(self, mono, values):
+        self.mono = mono
+        self.values = values
+
+
+class FrameTiming:
+    """Timings (milliseconds) of one processed frame"""
+    __slots__ = ('mono', 'wait_ms', 'inference_ms', 'processing_ms')
+
+    def __init__(self, mono, wait_ms, inference_ms, processing_ms):
+        self.mono = mono
+        self.wait_ms = wait_ms
+        self.inference_ms = inference_ms
+        self.processing_ms = processing_ms
+
+    def as_dict(self, ts):
+        return {"ts": ts, "waitMs": self.wait_ms, "inferenceMs": self.inference_ms,
+                "processingMs": self.processing_ms}
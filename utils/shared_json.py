@@ -0,0 +1,63 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from multiprocessing import Array, Lock, Value
+from json import dumps, loads
+import time
+
+
+class SharedJSON:
+    """JSON value in shared memory, readable from any process without a Manager server
+    process. A process decodes the value only after it was changed, otherwise get()
+    returns the same object, so readers can detect changes with an identity check.
+    Values are set by the process that created the value. Readers take no lock, so a
+    killed reader cannot block the writer: a write makes the version odd until it is
+    complete, and a read is repeated when the version changed while reading."""
+
+    def __init__(self, value=None, capacity=65536):
+        self._buffer = Array('c', capacity, lock=False)
+        self._length = Value('i', 0, lock=False)
+        self._version = Value('i', 0, lock=False)
+        self._write_lock = Lock()
+        # Version and value last decoded by this process, replaced together
+        self._cached = (-1, None)
+        self.set(value)
+
+    def fits(self, value):
+        return len(dumps(value).encode()) <= len(self._buffer)
+
+    def set(self, value):
+        data = dumps(value).encode()
+        if len(data) > len(self._buffer):
+            raise ValueError("shared value of %d bytes exceeds %d bytes" % (len(data), len(self._buffer)))
+        with self._write_lock:
+            self._version.value += 1
+            self._buffer[:len(data)] = data
+            self._length.value = len(data)
+            self._version.value += 1
+
+    def get(self):
+        while True:
+            cached_version, cached_value = self._cached
+            version = self._version.value
+            if version == cached_version:
+                return cached_value
+            if version % 2 == 0:
+                data = self._buffer[:self._length.value]
+                if self._version.value == version:
+                    break
+            time.sleep(0)
+        self._cached = (version, loads(data))
+        return self._cached[1]
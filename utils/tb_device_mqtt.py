@@ -17,11 +17,11 @@ import logging
 import queue
 import ssl
 import time
+from copy import deepcopy
 from json import dumps, loads
-from threading import RLock, Thread
+from threading import Event, RLock, Thread
 
 import paho.mqtt.client as paho
-from jsonschema import Draft7Validator, ValidationError
 
 KV_SCHEMA = {
     "type": "object",
@@ -69,11 +69,28 @@ DEVICE_TS_OR_KV_SCHEMA = {
             ]
     }
 }
-RPC_VALIDATOR = Draft7Validator(SCHEMA_FOR_CLIENT_RPC)
-KV_VALIDATOR = Draft7Validator(KV_SCHEMA)
-TS_KV_VALIDATOR = Draft7Validator(TS_KV_SCHEMA)
-DEVICE_TS_KV_VALIDATOR = Draft7Validator(DEVICE_TS_KV_SCHEMA)
-DEVICE_TS_OR_KV_VALIDATOR = Draft7Validator(DEVICE_TS_OR_KV_SCHEMA)
+
+
+class LazyValidator:
+    """Draft7Validator of a schema, built with the first use so that jsonschema is imported
+    only by processes that validate payloads"""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._validator = None
+
+    def __getattr__(self, name):
+        if self._validator is None:
+            from jsonschema import Draft7Validator
+            self._validator = Draft7Validator(self.schema)
+        return getattr(self._validator, name)
+
+
+RPC_VALIDATOR = LazyValidator(SCHEMA_FOR_CLIENT_RPC)
+KV_VALIDATOR = LazyValidator(KV_SCHEMA)
+TS_KV_VALIDATOR = LazyValidator(TS_KV_SCHEMA)
+DEVICE_TS_KV_VALIDATOR = LazyValidator(DEVICE_TS_KV_SCHEMA)
+DEVICE_TS_OR_KV_VALIDATOR = LazyValidator(DEVICE_TS_OR_KV_SCHEMA)
 
 RPC_RESPONSE_TOPIC = 'v1/devices/me/rpc/response/'
 RPC_REQUEST_TOPIC = 'v1/devices/me/rpc/request/'
@@ -107,7 +124,7 @@ class ProvisionClient(paho.Client):
     PROVISION_REQUEST_TOPIC = "/provision/request"
     PROVISION_RESPONSE_TOPIC = "/provision/response"
 
-    def __init__(self, host, port, provision_request):
+    def __init__(self, host, port, provision_request=None):
         super().__init__()
         self._host = host
         self._port = port
@@ -115,20 +132,19 @@ class ProvisionClient(paho.Client):
         self.on_connect = self.__on_connect
         self.on_message = self.__on_message
         self.__provision_request = provision_request
+        self.__credentials = None
+        self.__subscribed = Event()
+        self.__response = Event()
 
     def __on_connect(self, client, userdata, flags, rc):  # Callback for connect
         if rc == 0:
             log.info("[Provisioning client] Connected to ThingsBoard ")
             # Subscribe to provisioning response topic
             client.subscribe(self.PROVISION_RESPONSE_TOPIC)
-            provision_request = dumps(self.__provision_request)
-            log.info(
-                "[Provisioning client] Sending provisioning request %s" % provision_request)
-            # Publishing provisioning request topic
-            client.publish(self.PROVISION_REQUEST_TOPIC, provision_request)
+            self.__subscribed.set()
         else:
             log.info(
-                "[Provisioning client] Cannot connect to ThingsBoard!, result: %s" % RESULT_CODES[rc])
+                "[Provisioning client] Cannot connect to ThingsBoard!, result: %s" % RESULT_CODES.get(rc, rc))
 
     def __on_message(self, client, userdata, msg):
         decoded_payload = msg.payload.decode("UTF-8")
@@ -140,14 +156,13 @@ class ProvisionClient(paho.Client):
             self.__credentials = decoded_message["credentialsValue"]
         else:
             log.error("[Provisioning client] Provisioning was unsuccessful with status %s and message: %s" % (
-                provision_device_status, decoded_message["errorMsg"]))
-        self.disconnect()
+                provision_device_status, decoded_message.get("errorMsg")))
+        self.__response.set()
 
-    def provision(self, tls=False, ca_certs=None, cert_file=None, key_file=None,):
+    def open(self, tls=False, ca_certs=None, cert_file=None, key_file=None, timeout=30):
+        """Connects to ThingsBoard and waits until the provisioning response topic is subscribed"""
         log.info("[Provisioning client] Connecting to ThingsBoard")
-        self.__credentials = None
-        self.connect(self._host, self._port, 60)
-        if tls:
+        if tls and self._ssl_context is None:
             try:
                 self.tls_set(ca_certs=ca_certs,
                              certfile=cert_file,
@@ -158,7 +173,37 @@ class ProvisionClient(paho.Client):
                 self.tls_insecure_set(False)
             except ValueError:
                 pass
-        self.loop_forever()
+        self.__subscribed.clear()
+        self.connect(self._host, self._port, 60)
+        self.loop_start()
+        if not self.__subscribed.wait(timeout):
+            self.close()
+            raise TBTimeoutException("Timeout while connecting to ThingsBoard!")
+
+    def close(self):
+        self.disconnect()
+        self.loop_stop()
+
+    def request(self, provision_request, timeout=30) -> str:
+        """Sends a provisioning request over the open connection and waits for the response.
+        Returns the device credentials, or an empty string if provisioning was rejected"""
+        self.__credentials = None
+        self.__response.clear()
+        provision_request = dumps(provision_request)
+        log.info(
+            "[Provisioning client] Sending provisioning request %s" % provision_request)
+        # Publishing provisioning request topic
+        self.publish(self.PROVISION_REQUEST_TOPIC, provision_request)
+        if not self.__response.wait(timeout):
+            raise TBTimeoutException("Timeout while waiting for a reply from ThingsBoard!")
+        return self.get_credentials()
+
+    def provision(self, tls=False, ca_certs=None, cert_file=None, key_file=None, timeout=30):
+        self.open(tls=tls, ca_certs=ca_certs, cert_file=cert_file, key_file=key_file, timeout=timeout)
+        try:
+            self.request(self.__provision_request, timeout)
+        finally:
+            self.close()
 
     def get_credentials(self) -> str:
         return self.__credentials if self.__credentials is not None else ""
@@ -198,10 +243,23 @@ class TBPublishInfo:
         return self.message_info.rc
 
 
+class TLSSessionContext(ssl.SSLContext):
+    """SSL context that resumes the previous TLS session when paho opens a new socket,
+    which saves a full handshake on every reconnect"""
+    tls_session = None
+
+    def wrap_socket(self, *args, **kwargs):
+        if kwargs.get("session") is None and self.tls_session is not None:
+            kwargs["session"] = self.tls_session
+        return super().wrap_socket(*args, **kwargs)
+
+
 class TBDeviceMqttClient:
-    def __init__(self, host, token=None, port=1883, quality_of_service=None):
-        self._client = paho.Client()
+    def __init__(self, host, token=None, port=1883, quality_of_service=None, client_id="", clean_session=True,
+                 validate_payloads=True):
+        self._client = paho.Client(client_id=client_id, clean_session=clean_session)
         self.quality_of_service = quality_of_service if quality_of_service is not None else 1
+        self._validate_payloads = validate_payloads
         self.__host = host
         self.__port = port
         if token == "":
@@ -211,13 +269,23 @@ class TBDeviceMqttClient:
             self._client.username_pw_set(token)
         self._lock = RLock()
 
+        # Attribute requests by request id, each with its key set and waiting callbacks,
+        # the id of the request in flight for a key set and the last response for a key set
         self._attr_request_dict = {}
+        self._attr_requests_in_flight = {}
+        self._attr_cache = {}
+        # Message ids of QoS>0 publishes still waiting for an acknowledgement, and of QoS0
+        # publishes paho has not written to the socket yet (paho does not limit those)
+        self._pending_mids = set()
+        self._pending_qos0_mids = set()
         self.stopped = False
         self.__timeout_queue = queue.Queue()
         self.__timeout_thread = Thread(target=self.__timeout_check)
         self.__timeout_thread.daemon = True
         self.__timeout_thread.start()
         self.__is_connected = False
+        self.__tls_context = None
+        self.session_present = False
         self.__device_on_server_side_rpc_response = None
         self.__connect_callback = None
         self.__device_max_sub_id = 0
@@ -226,30 +294,47 @@ class TBDeviceMqttClient:
         self.__device_client_rpc_dict = {}
         self.__attr_request_number = 0
         self._client.on_connect = self._on_connect
-        self._client.on_log = self._on_log
+        # paho formats its log messages only when the logger is enabled for their level
+        self._client.enable_logger(logging.getLogger(__name__ + ".paho"))
         self._client.on_publish = self._on_publish
         self._client.on_message = self._on_message
         self._client.on_disconnect = self._on_disconnect
         # TODO: enable configuration available here:
         # https://pypi.org/project/paho-mqtt/#option-functions
 
-    def _on_log(self, client, userdata, level, buf):
-        #     if isinstance(buf, Exception):
-        #         log.exception(buf)
-        #     else:
-        #         log.debug("%s - %s - %s - %s", client, userdata, level, buf)
-        pass
+    def _on_publish(self, client, userdata, mid):
+        with self._lock:
+            self._pending_mids.discard(mid)
+            self._pending_qos0_mids.discard(mid)
+
+    def _track_publish(self, info, qos):
+        # QoS0 messages are dropped by paho when there is no connection
+        if qos == 0 and info.rc == paho.MQTT_ERR_SUCCESS:
+            pending = self._pending_qos0_mids
+        elif qos > 0 and info.rc in (paho.MQTT_ERR_SUCCESS, paho.MQTT_ERR_NO_CONN):
+            pending = self._pending_mids
+        else:
+            return
+        with self._lock:
+            pending.add(info.mid)
+        # the acknowledgement may have arrived before the mid was registered. is_published()
+        # raises for messages paho could not send yet, they stay pending until the connect
+        if info.rc == paho.MQTT_ERR_SUCCESS and info.is_published():
+            with self._lock:
+                pending.discard(info.mid)
 
-    def _on_publish(self, client, userdata, result):
-        # log.debug("Data published to ThingsBoard!")
-        pass
+    def pending_publishes(self):
+        """Number of QoS>0 messages published but not yet acknowledged by the broker, and
+        of QoS0 messages not yet written to the socket"""
+        return len(self._pending_mids) + len(self._pending_qos0_mids)
 
     def _on_disconnect(self, client, userdata, result_code):
-        prev_level = log.level
-        log.setLevel("DEBUG")
-        log.debug("Disconnected client: %s, user data: %s, result code: %s", str(
-            client), str(userdata), str(result_code))
-        log.setLevel(prev_level)
+        log.info("Disconnected, result code: %s", result_code)
+        self.__is_connected = False
+        # attribute updates may be missed until the next connection, unsent QoS0 messages are lost
+        with self._lock:
+            self._attr_cache.clear()
+            self._pending_qos0_mids.clear()
         if self.__connect_callback:
             time.sleep(.05)
             self.__connect_callback(self, userdata, None, result_code)
@@ -258,17 +343,23 @@ class TBDeviceMqttClient:
         print("connect callback called")
 
     def _on_connect(self, client, userdata, flags, result_code, *extra_params):
+        with self._lock:
+            self._attr_cache.clear()
         if result_code == 0:
             self.__is_connected = True
-            log.info("connection SUCCESS")
-            self._client.subscribe(
-                ATTRIBUTES_TOPIC, qos=self.quality_of_service)
-            self._client.subscribe(
-                ATTRIBUTES_TOPIC + "/response/+", qos=self.quality_of_service)
-            self._client.subscribe(RPC_REQUEST_TOPIC +
-                                   '+', qos=self.quality_of_service)
-            self._client.subscribe(
-                RPC_RESPONSE_TOPIC + '+', qos=self.quality_of_service)
+            self.session_present = bool(flags.get("session present"))
+            self._store_tls_session()
+            log.info("connection SUCCESS, session present: %s", self.session_present)
+            # subscriptions of a persistent session survive reconnects
+            if not self.session_present:
+                self._client.subscribe(
+                    ATTRIBUTES_TOPIC, qos=self.quality_of_service)
+                self._client.subscribe(
+                    ATTRIBUTES_TOPIC + "/response/+", qos=self.quality_of_service)
+                self._client.subscribe(RPC_REQUEST_TOPIC +
+                                       '+', qos=self.quality_of_service)
+                self._client.subscribe(
+                    RPC_RESPONSE_TOPIC + '+', qos=self.quality_of_service)
         else:
             if result_code in RESULT_CODES:
                 log.error("connection FAIL with error %s %s",
@@ -280,21 +371,39 @@ class TBDeviceMqttClient:
             self.__connect_callback(
                 self, userdata, flags, result_code, *extra_params)
 
+    def _store_tls_session(self):
+        if self.__tls_context is None:
+            return
+        sock = self._client.socket()
+        session = getattr(sock, "session", None)
+        if session is not None:
+            self.__tls_context.tls_session = session
+            log.debug("TLS session stored, reused: %s", sock.session_reused)
+
+    def _tls_set(self, ca_certs=None, cert_file=None, key_file=None):
+        """Configures TLS once per client, equivalent to paho tls_set with TLSv1.2 and
+        certificate verification, but able to resume TLS sessions"""
+        if self.__tls_context is not None:
+            return
+        context = TLSSessionContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+        if ca_certs is not None:
+            context.load_verify_locations(ca_certs)
+        else:
+            context.load_default_certs()
+        if cert_file is not None:
+            context.load_cert_chain(cert_file, key_file)
+        self._client.tls_set_context(context)
+        self._client.tls_insecure_set(False)
+        self.__tls_context = context
+
     def is_connected(self):
         return self.__is_connected
 
     def connect(self, callback=None, min_reconnect_delay=1, timeout=120, tls=False, ca_certs=None, cert_file=None, key_file=None, keepalive=120):
         if tls:
-            try:
-                self._client.tls_set(ca_certs=ca_certs,
-                                     certfile=cert_file,
-                                     keyfile=key_file,
-                                     cert_reqs=ssl.CERT_REQUIRED,
-                                     tls_version=ssl.PROTOCOL_TLSv1_2,
-                                     ciphers=None)
-                self._client.tls_insecure_set(False)
-            except ValueError:
-                pass
+            self._tls_set(ca_certs=ca_certs, cert_file=cert_file, key_file=key_file)
         self.reconnect_delay_set(min_reconnect_delay, timeout)
         self.__connect_callback = callback
         self._client.loop_start()
@@ -321,12 +430,12 @@ class TBDeviceMqttClient:
     @staticmethod
     def _decode(message):
         content = loads(message.payload.decode("utf-8"))
-        log.debug(content)
-        log.debug(message.topic)
+        log.debug("Message on %s: %s", message.topic, content)
         return content
 
     @staticmethod
     def validate(validator, data):
+        from jsonschema import ValidationError
         try:
             validator.validate(data)
         except ValidationError as e:
@@ -349,6 +458,7 @@ class TBDeviceMqttClient:
         elif message.topic == ATTRIBUTES_TOPIC:
             dict_results = []
             with self._lock:
+                self._invalidate_attributes(shared_keys=set(content) | set(content.get("deleted", [])))
                 # callbacks for everything
                 if self.__device_sub_dict.get("*"):
                     for subscription_id in self.__device_sub_dict["*"]:
@@ -372,9 +482,13 @@ class TBDeviceMqttClient:
             with self._lock:
                 req_id = int(
                     message.topic[len(ATTRIBUTES_TOPIC + "/response/"):])
-                # pop callback and use it
-                callback = self._attr_request_dict.pop(req_id)
-            callback(client, content, None)
+                # pop the request, cache the response and pass it to every waiting callback
+                request = self._attr_request_dict.pop(req_id, None)
+                if request is not None:
+                    self._attr_requests_in_flight.pop(request["keys"], None)
+                    self._attr_cache[request["keys"]] = content
+            if request is not None:
+                self._notify_attribute_request(request["callbacks"], content, None)
 
     def max_inflight_messages_set(self, inflight):
         """Set the maximum number of messages with QoS>0 that can be part way through their network flow at once.
@@ -404,7 +518,8 @@ class TBDeviceMqttClient:
             info.wait_for_publish()
 
     def send_rpc_call(self, method, params, callback):
-        self.validate(RPC_VALIDATOR, params)
+        if self._validate_payloads:
+            self.validate(RPC_VALIDATOR, params)
         with self._lock:
             self.__device_client_rpc_number += 1
             self.__device_client_rpc_dict.update(
@@ -426,17 +541,22 @@ class TBDeviceMqttClient:
             log.exception("Quality of service (qos) value must be 0 or 1")
             raise TBQoSException(
                 "Quality of service (qos) value must be 0 or 1")
-        return TBPublishInfo(self._client.publish(topic, data, qos))
+        info = self._client.publish(topic, data, qos)
+        self._track_publish(info, qos)
+        return TBPublishInfo(info)
 
     def send_telemetry(self, telemetry, quality_of_service=None):
         quality_of_service = quality_of_service if quality_of_service is not None else self.quality_of_service
         if not isinstance(telemetry, list):
             telemetry = [telemetry]
-        self.validate(DEVICE_TS_OR_KV_VALIDATOR, telemetry)
+        if self._validate_payloads:
+            self.validate(DEVICE_TS_OR_KV_VALIDATOR, telemetry)
         return self.publish_data(telemetry, TELEMETRY_TOPIC, quality_of_service)
 
     def send_attributes(self, attributes, quality_of_service=None):
         quality_of_service = quality_of_service if quality_of_service is not None else self.quality_of_service
+        with self._lock:
+            self._invalidate_attributes(client_keys=set(attributes))
         return self.publish_data(attributes, ATTRIBUTES_TOPIC, quality_of_service)
 
     def unsubscribe_from_attribute(self, subscription_id):
@@ -467,10 +587,26 @@ class TBDeviceMqttClient:
                       key, self.__device_max_sub_id)
             return self.__device_max_sub_id
 
-    def request_attributes(self, client_keys=None, shared_keys=None, callback=None):
+    def request_attributes(self, client_keys=None, shared_keys=None, callback=None, use_cache=True):
+        """Requests client and shared attribute values. Concurrent requests for the same keys
+        share a single request and timeout. Responses are cached until one of their keys is
+        updated or the connection is lost, so a cached response is passed to the callback right
+        away unless use_cache is False. Returns publish info, or None when no message was sent"""
         if client_keys is None and shared_keys is None:
             log.error("There are no keys to request")
             return False
+        keys = (frozenset(client_keys or ()), frozenset(shared_keys or ()))
+        with self._lock:
+            cached = self._attr_cache.get(keys) if use_cache else None
+            in_flight = self._attr_requests_in_flight.get(keys)
+            if cached is None and in_flight is not None:
+                self._attr_request_dict[in_flight]["callbacks"].append(callback)
+                log.debug("Attribute request %i already in flight", in_flight)
+                return None
+        if cached is not None:
+            self._notify_attribute_request([callback], cached, None)
+            return None
+
         msg = {}
         if client_keys:
             tmp = ""
@@ -485,11 +621,12 @@ class TBDeviceMqttClient:
             tmp = tmp[:len(tmp) - 1]
             msg.update({"sharedKeys": tmp})
 
-        ts_in_millis = int(round(time.time() * 1000))
+        # timeouts use the monotonic clock, wall clock steps must not fire them early or never
+        ts_in_millis = int(round(time.monotonic() * 1000))
 
-        attr_request_number = self._add_attr_request_callback(callback)
+        attr_request_number = self._add_attr_request_callback(keys, callback)
 
-        info = self._client.publish(topic=ATTRIBUTES_TOPIC_REQUEST + str(self.__attr_request_number),
+        info = self._client.publish(topic=ATTRIBUTES_TOPIC_REQUEST + str(attr_request_number),
                                     payload=dumps(msg),
                                     qos=self.quality_of_service)
         self._add_timeout(attr_request_number, ts_in_millis + 30000)
@@ -499,37 +636,51 @@ class TBDeviceMqttClient:
         self.__timeout_queue.put(
             {"ts": timestamp, "attribute_request_id": attr_request_number})
 
-    def _add_attr_request_callback(self, callback):
+    def _add_attr_request_callback(self, keys, callback):
         with self._lock:
             self.__attr_request_number += 1
             self._attr_request_dict.update(
-                {self.__attr_request_number: callback})
+                {self.__attr_request_number: {"keys": keys, "callbacks": [callback]}})
             attr_request_number = self.__attr_request_number
+            self._attr_requests_in_flight[keys] = attr_request_number
         return attr_request_number
 
+    def _invalidate_attributes(self, client_keys=(), shared_keys=()):
+        """Drops cached attribute responses holding any of the keys. Called with the lock held"""
+        for keys in list(self._attr_cache):
+            if not keys[0].isdisjoint(client_keys) or not keys[1].isdisjoint(shared_keys):
+                del self._attr_cache[keys]
+
+    def _notify_attribute_request(self, callbacks, content, exception):
+        for callback in callbacks:
+            if callback is not None:
+                callback(self, deepcopy(content), exception)
+
     def __timeout_check(self):
         while not self.stopped:
             if not self.__timeout_queue.empty():
                 item = self.__timeout_queue.get_nowait()
                 if item is not None:
                     while not self.stopped:
-                        current_ts_in_millis = int(round(time.time() * 1000))
+                        current_ts_in_millis = int(round(time.monotonic() * 1000))
                         if current_ts_in_millis > item["ts"]:
                             break
-                        time.sleep(0.001)
+                        time.sleep(min(item["ts"] - current_ts_in_millis + 1, 100) / 1000)
                     with self._lock:
-                        callback = None
+                        callbacks = []
                         if item.get("attribute_request_id"):
-                            if self._attr_request_dict.get(item["attribute_request_id"]):
-                                callback = self._attr_request_dict.pop(
-                                    item["attribute_request_id"])
+                            request = self._attr_request_dict.pop(item["attribute_request_id"], None)
+                            if request is not None:
+                                self._attr_requests_in_flight.pop(request["keys"], None)
+                                callbacks = request["callbacks"]
                         elif item.get("rpc_request_id"):
                             if self.__device_client_rpc_dict.get(item["rpc_request_id"]):
-                                callback = self.__device_client_rpc_dict.pop(
-                                    item["rpc_request_id"])
-                    if callback is not None:
-                        callback(self, None, TBTimeoutException(
-                            "Timeout while waiting for a reply from ThingsBoard!"))
+                                callbacks = [self.__device_client_rpc_dict.pop(
+                                    item["rpc_request_id"])]
+                    for callback in callbacks:
+                        if callback is not None:
+                            callback(self, None, TBTimeoutException(
+                                "Timeout while waiting for a reply from ThingsBoard!"))
             else:
                 time.sleep(0.01)
 
@@ -543,20 +694,14 @@ class TBDeviceMqttClient:
         return info
 
     @staticmethod
-    def provision(host,
-                  provision_device_key,
-                  provision_device_secret,
-                  port=1883,
-                  device_name=None,
-                  access_token=None,
-                  client_id=None,
-                  username=None,
-                  password=None,
-                  hash=None,
-                  tls=False,
-                  ca_certs=None,
-                  cert_file=None,
-                  key_file=None):
+    def provision_request(provision_device_key,
+                          provision_device_secret,
+                          device_name=None,
+                          access_token=None,
+                          client_id=None,
+                          username=None,
+                          password=None,
+                          hash=None):
         provision_request = {
             "provisionDeviceKey": provision_device_key,
             "provisionDeviceSecret": provision_device_secret
@@ -576,9 +721,29 @@ class TBDeviceMqttClient:
 
         if device_name is not None:
             provision_request["deviceName"] = device_name
+        return provision_request
 
+    @staticmethod
+    def provision(host,
+                  provision_device_key,
+                  provision_device_secret,
+                  port=1883,
+                  device_name=None,
+                  access_token=None,
+                  client_id=None,
+                  username=None,
+                  password=None,
+                  hash=None,
+                  tls=False,
+                  ca_certs=None,
+                  cert_file=None,
+                  key_file=None,
+                  timeout=30):
+        provision_request = TBDeviceMqttClient.provision_request(
+            provision_device_key, provision_device_secret, device_name, access_token,
+            client_id, username, password, hash)
         provisioning_client = ProvisionClient(
             host=host, port=port, provision_request=provision_request)
         provisioning_client.provision(
-            tls=tls, ca_certs=ca_certs, cert_file=cert_file, key_file=key_file)
+            tls=tls, ca_certs=ca_certs, cert_file=cert_file, key_file=key_file, timeout=timeout)
         return provisioning_client.get_credentials()
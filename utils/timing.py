@@ -0,0 +1,64 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+import ctypes
+import ctypes.util
+import logging
+import time
+log = logging.getLogger(__name__)
+
+# adjtimex return value of a clock that is not synchronized to a time source
+_TIME_ERROR = 5
+
+
+def clock_synchronized() -> bool:
+    """Whether the kernel reports the wall clock as synchronized (e.g. by NTP). Always
+    True where adjtimex is not available"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        timex = ctypes.create_string_buffer(256)  # struct timex with modes = 0, read only
+        return libc.adjtimex(timex) != _TIME_ERROR
+    except (OSError, AttributeError, TypeError):
+        return True
+
+
+class WallClock:
+    """Converts monotonic capture times to wall-clock timestamps at the time they are sent.
+    The conversion uses the current offset between both clocks, so records captured before
+    the clock was stepped (NTP sync of a Pi without RTC) get corrected timestamps."""
+
+    def __init__(self, jump_threshold=1.0, check_interval=5.0):
+        self._jump_threshold = jump_threshold
+        self._check_interval = check_interval
+        self._offset = time.time() - time.monotonic()
+        self._synchronized = None
+        self._checked = 0.0
+
+    def offset(self) -> float:
+        offset = time.time() - time.monotonic()
+        if abs(offset - self._offset) > self._jump_threshold:
+            log.info("Wall clock stepped by %.1f s", offset - self._offset)
+        self._offset = offset
+        return offset
+
+    def to_wall_ms(self, monotonic_time) -> int:
+        return int(round((monotonic_time + self.offset()) * 1000))
+
+    def synchronized(self) -> bool:
+        now = time.monotonic()
+        if self._synchronized is None or now - self._checked > self._check_interval:
+            self._synchronized = clock_synchronized()
+            self._checked = now
+        return self._synchronized
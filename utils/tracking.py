@@ -0,0 +1,146 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from typing import Dict, List, Optional
+import numpy as np
+
+
+class Track:
+    __slots__ = ('track_id', 'point', 'first_seen', 'last_seen', 'missed')
+
+    def __init__(self, track_id, point, ts):
+        self.track_id = track_id
+        self.point = point
+        self.first_seen = ts
+        self.last_seen = ts
+        self.missed = 0
+
+
+def _segments_intersect(p1, p2, q1, q2):
+    def orientation(a, b, c):
+        return np.sign((b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0]))
+    return (orientation(p1, p2, q1) != orientation(p1, p2, q2) and
+            orientation(q1, q2, p1) != orientation(q1, q2, p2))
+
+
+class Tracker:
+    """Associates detections across frames by greedy nearest-centroid matching and counts
+    tracks crossing the counting line. Points are foot points in normalized frame coordinates.
+    A detection matches a track within max_distance plus the distance a person moving at
+    max_speed (frame sizes per second) covers since the track was last seen, so low frame
+    rates do not break tracks. The reach is capped at max_gate, and tracks not seen for
+    max_gap seconds end, so long detection intervals do not pair unrelated people. Direction of a crossing is relative to the line direction:
+    for a line drawn from the top of the image to the bottom, moving from right to left is
+    an entry and back is an exit. Entries and exits are counted from the given totals."""
+
+    def __init__(self, max_distance=0.1, max_speed=0.6, max_gate=0.5, max_missed=3, max_gap=5.0,
+                 entries=0, exits=0):
+        self._max_distance = max_distance
+        self._max_speed = max_speed
+        self._max_gate = max_gate
+        self._max_missed = max_missed
+        self._max_gap = max_gap
+        self._tracks: List[Track] = []
+        self._next_id = 1
+        self._line: Optional[np.ndarray] = None
+        self._entries = entries
+        self._exits = exits
+        self._dwell_times: List[float] = []
+
+    def set_line(self, line):
+        """Sets the counting line as [[x1, y1], [x2, y2]], or None to disable counting"""
+        self._line = np.asarray(line, dtype=np.float32) if line else None
+
+    def _match(self, points, ts):
+        """Greedy assignment of detections to tracks by ascending centroid distance"""
+        if (not self._tracks or not len(points)):
+            return []
+        track_points = np.array([track.point for track in self._tracks], dtype=np.float32)
+        distances = np.linalg.norm(track_points[:, None, :] - points[None, :, :], axis=2)
+        gates = np.array([min(self._max_distance + self._max_speed * (ts - track.last_seen), self._max_gate)
+                          for track in self._tracks])
+        # detections out of reach of a track are never matched to it
+        distances[distances > gates[:, None]] = np.inf
+        matches = []
+        track_used = np.zeros(len(self._tracks), dtype=bool)
+        point_used = np.zeros(len(points), dtype=bool)
+        for flat in np.argsort(distances, axis=None):
+            t, p = np.unravel_index(flat, distances.shape)
+            if (distances[t, p] == np.inf):
+                break
+            if (track_used[t] or point_used[p]):
+                continue
+            track_used[t] = point_used[p] = True
+            matches.append((t, p))
+        return matches
+
+    def _count_crossing(self, previous, current):
+        a, b = self._line
+        if (not _segments_intersect(previous, current, a, b)):
+            return
+        side = (b[0] - a[0]) * (current[1] - a[1]) - (b[1] - a[1]) * (current[0] - a[0])
+        if (side > 0):
+            self._entries += 1
+        else:
+            self._exits += 1
+
+    def update(self, points: np.ndarray, ts: float):
+        """Updates tracks with the foot points of one frame taken at ts (seconds)"""
+        self._end_tracks([track for track in self._tracks if ts - track.last_seen > self._max_gap])
+        matched_tracks = set()
+        matched_points = set()
+        for t, p in self._match(points, ts):
+            track = self._tracks[t]
+            if (self._line is not None):
+                self._count_crossing(track.point, points[p])
+            track.point = points[p]
+            track.last_seen = ts
+            track.missed = 0
+            matched_tracks.add(t)
+            matched_points.add(p)
+        alive = []
+        for t, track in enumerate(self._tracks):
+            if (t not in matched_tracks):
+                track.missed += 1
+                if (track.missed > self._max_missed):
+                    self._dwell_times.append(track.last_seen - track.first_seen)
+                    continue
+            alive.append(track)
+        for p in range(len(points)):
+            if (p not in matched_points):
+                alive.append(Track(self._next_id, points[p], ts))
+                self._next_id += 1
+        self._tracks = alive
+
+    def _end_tracks(self, ended: List[Track]):
+        for track in ended:
+            self._dwell_times.append(track.last_seen - track.first_seen)
+        if (ended):
+            self._tracks = [track for track in self._tracks if track not in ended]
+
+    def active_tracks(self) -> int:
+        return len([track for track in self._tracks if track.missed == 0])
+
+    def collect(self) -> Dict[str, float]:
+        """Returns telemetry values: total entries and exits, so a lost record does not lose
+        crossings, and dwell times of tracks ended since the previous call"""
+        values = {"entriesTotal": self._entries, "exitsTotal": self._exits,
+                  "trackedPeople": self.active_tracks()}
+        if (self._dwell_times):
+            values["dwellTimeAvg"] = round(float(sum(self._dwell_times)) / len(self._dwell_times), 1)
+            values["dwellTimeMax"] = round(float(max(self._dwell_times)), 1)
+            values["dwellTimeCount"] = len(self._dwell_times)
+        self._dwell_times = []
+        return values
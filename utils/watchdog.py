@@ -0,0 +1,40 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from multiprocessing import Array
+from typing import Optional
+import time
+
+
+class Heartbeats:
+    """Heartbeat times of worker stages in shared memory, readable from any process.
+    Times come from the system-wide monotonic clock, so they compare across processes.
+    A stage without a heartbeat (never started or finished) has no age."""
+
+    def __init__(self, stages):
+        self._stages = {stage: i for i, stage in enumerate(stages)}
+        self._times = Array('d', len(stages), lock=False)
+
+    def beat(self, stage):
+        self._times[self._stages[stage]] = time.monotonic()
+
+    def clear(self, *stages):
+        for stage in stages or self._stages:
+            self._times[self._stages[stage]] = 0.0
+
+    def age(self, stage) -> Optional[float]:
+        """Seconds since the last heartbeat of the stage, or None"""
+        beat = self._times[self._stages[stage]]
+        return time.monotonic() - beat if beat else None
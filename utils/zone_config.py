@@ -0,0 +1,49 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from typing import Dict, List, Optional
+
+DEFAULT_ZONE = 'default'
+
+
+def _valid_polygon(polygon):
+    return (type(polygon) is list and
+            len(polygon) >= 3 and
+            all(type(n) is dict and 'x' in n and 'y' in n and
+                n['x'] <= 1 and n['x'] >= 0 and
+                n['y'] <= 1 and n['y'] >= 0 for n in polygon))
+
+
+def parse_detection_bounds(bounds) -> Optional[Dict[str, List[List[float]]]]:
+    """Reads the detectionBounds attribute. It is either a single polygon (a list of points),
+    an object mapping zone names to polygons, or an empty object when no bounds are set.
+    Returns a dictionary of zone names to raw polygons, or None if bounds are invalid"""
+    try:
+        if (_valid_polygon(bounds)):
+            zones = {DEFAULT_ZONE: bounds}
+        elif (type(bounds) is dict and
+                all(type(name) is str and name and _valid_polygon(polygon)
+                    for name, polygon in bounds.items())):
+            zones = bounds
+        else:
+            return None
+        return {name: [[bound['x'], bound['y']] for bound in polygon]
+                for name, polygon in zones.items()}
+    except TypeError:
+        return None
+
+
+def zone_telemetry_key(name):
+    return 'numberOfPeople_' + name
@@ -0,0 +1,83 @@
+#      Copyright 2022. Yerzhan Zhamashev
+#  #
+#      Licensed under the GNU General Public License version 3 (the "License");
+#      you may not use this file except in compliance with the License.
+#      You may obtain a copy of the License at
+#  #
+#          https://opensource.org/licenses/GPL-3.0
+#  #
+#      Unless required by applicable law or agreed to in writing, software
+#      distributed under the License is distributed on an "AS IS" BASIS,
+#      WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#      See the License for the specific language governing permissions and
+#      limitations under the License.
+#
+
+from typing import Dict, List
+import numpy as np
+
+# Attribute parsing does not need NumPy and lives in zone_config, for the client process
+from utils.zone_config import DEFAULT_ZONE, parse_detection_bounds, zone_telemetry_key
+
+
+class ZoneIndex:
+    """Spatial index over named detection zones. Zone polygons are given in normalized
+    frame coordinates. The frame is split into a uniform grid and every cell stores which
+    zones overlap it, so a point only goes through the polygon test of its candidate zones."""
+
+    def __init__(self, zones: Dict[str, List[List[float]]], grid_size=8):
+        self._grid_size = grid_size
+        self._names = list(zones.keys())
+        self._polygons = [np.asarray(zones[name], dtype=np.float32) for name in self._names]
+        # Cell to zone candidate mask, shape (grid_size, grid_size, number of zones)
+        self._cells = np.zeros((grid_size, grid_size, len(self._names)), dtype=bool)
+        for i, polygon in enumerate(self._polygons):
+            low = self._cell_of(polygon.min(axis=0))
+            high = self._cell_of(polygon.max(axis=0))
+            self._cells[low[0]:high[0] + 1, low[1]:high[1] + 1, i] = True
+
+    def _cell_of(self, points):
+        return np.clip((np.asarray(points) * self._grid_size).astype(int), 0, self._grid_size - 1)
+
+    @staticmethod
+    def _inside(points, polygon):
+        """Vectorized even-odd ray casting of points against a single polygon"""
+        x, y = points[:, 0:1], points[:, 1:2]
+        x1, y1 = polygon[:, 0], polygon[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        return np.count_nonzero(crosses & (x < x_cross), axis=1) % 2 == 1
+
+    def names(self):
+        return list(self._names)
+
+    def membership(self, points: np.ndarray) -> np.ndarray:
+        """Boolean (number of points, number of zones) matrix of zone membership"""
+        result = np.zeros((len(points), len(self._names)), dtype=bool)
+        if (not len(points) or not self._names):
+            return result
+        cells = self._cell_of(points)
+        candidates = self._cells[cells[:, 0], cells[:, 1]]
+        for i, polygon in enumerate(self._polygons):
+            idx = np.flatnonzero(candidates[:, i])
+            if (idx.size):
+                result[idx, i] = self._inside(points[idx], polygon)
+        return result
+
+    def count(self, points: np.ndarray) -> Dict[str, int]:
+        """Number of points inside each zone"""
+        counts = self.membership(points).sum(axis=0)
+        return {name: int(counts[i]) for i, name in enumerate(self._names)}
+
+
+def people_values(zone_index: ZoneIndex, points: np.ndarray) -> Dict[str, int]:
+    """Telemetry values with the number of people in any zone (all people when there are
+    no zones) and the number of people in every zone"""
+    membership = zone_index.membership(points)
+    names = zone_index.names()
+    values = {"numberOfPeople": int(np.count_nonzero(membership.any(axis=1))) if names else len(points)}
+    for i, name in enumerate(names):
+        values[zone_telemetry_key(name)] = int(np.count_nonzero(membership[:, i]))
+    return values